@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+
+######################################################################
+## Runs cloudcoreo-directory-backup.py end to end against a local s3
+## stand-in (benchmarks/fakes3.py) on synthetic trees of several shapes:
+## a full backup, a restore, a --restore-stamp restore and a cleanup
+## through a history of thousands of snapshots. Every run is timed and
+## reported with its MB/s, peak RSS and s3 request counts, and compared
+## against a stored baseline when there is one.
+##   example:
+##       python benchmarks/backup-benchmark.py \
+##              --shapes small-text,huge-random \
+##              --size 256 \
+##              --history 5000 \
+##              --script-args "--codec zstd --stream" \
+##              --baseline benchmarks/backup-baseline.json
+##
+######################################################################
+import os
+import sys
+import json
+import time
+import shlex
+import random
+import shutil
+import argparse
+import datetime
+import tempfile
+import subprocess
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(BENCHMARKS, os.pardir, "cloudcoreo-directory-backup.py")
+FAKE_S3 = os.path.join(BENCHMARKS, "fakes3.py")
+PREFIX = "bench"
+
+sys.path.insert(0, BENCHMARKS)
+import fakes3
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Time backups, restores and cleanups against a local s3 stand-in")
+    parser.add_argument("--shapes",            dest="shapes",                      default=",".join(sorted(SHAPES)), help="A CSV of the tree shapes to run: %s" % ", ".join(sorted(SHAPES)))
+    parser.add_argument("--size",              dest="size",              type=int, default=64,             help="About how many MB every tree holds")
+    parser.add_argument("--history",           dest="history",           type=int, default=2000,           help="How many older snapshots to add before the --restore-stamp and cleanup runs")
+    parser.add_argument("--script-args",       dest="scriptArgs",                  default="",             help="Extra arguments for every run of the backup script, e.g. \"--codec zstd --stream\"")
+    parser.add_argument("--work-dir",          dest="workDir",                     default=None,           help="Where the trees, the fake bucket and the logs go - a temporary directory by default")
+    parser.add_argument("--keep",              dest="keep",              action="store_true", default=False, help="Don't delete the work dir afterwards")
+    parser.add_argument("--baseline",          dest="baseline",                    default=None,           help="A json file of earlier results to compare against")
+    parser.add_argument("--save-baseline",     dest="saveBaseline",                default=None,           help="Write the results to this json file, to compare later runs against")
+    parser.add_argument("--tolerance",         dest="tolerance",         type=float, default=0.2,          help="How much slower (or bigger) than the baseline a run may be before it is reported as a regression")
+    parser.add_argument("--seed",              dest="seed",              type=int, default=1,              help="The seed of the synthetic trees")
+    return parser.parse_args()
+
+######################################################################
+## synthetic trees
+######################################################################
+class DataSource(object):
+    ## text is sliced out of one block of seeded words, so it compresses like real text
+    ## and the trees come out the same for the same seed; random data doesn't compress
+    def __init__(self, rand, compressible):
+        self.rand = rand
+        self.compressible = compressible
+        if compressible:
+            words = ["".join(rand.choice("abcdefghijklmnopqrstuvwxyz") for i in range(rand.randint(2, 10))) for w in range(2000)]
+            self.text = " ".join(rand.choice(words) for i in range(800000))
+
+    def write(self, path, size):
+        with open(path, 'wb') as f:
+            while size > 0:
+                block = min(size, 1048576)
+                if self.compressible:
+                    start = self.rand.randint(0, len(self.text) - block)
+                    f.write(self.text[start:start + block])
+                else:
+                    f.write(os.urandom(block))
+                size -= block
+
+def makeFiles(root, rand, source, total, minSize, maxSize, filesPerDir, depth=1):
+    ## files of minSize-maxSize bytes until there are <total> bytes, filesPerDir to a
+    ## directory, the directories nested <depth> levels deep
+    written = 0
+    count = 0
+    while written < total:
+        parts = ["d%03d" % ((count // filesPerDir) % 1000)] + ["n%02d" % level for level in range(depth - 1)]
+        directory = os.path.join(root, *parts)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        size = min(rand.randint(minSize, maxSize), total - written)
+        source.write(os.path.join(directory, "f%06d.dat" % count), size)
+        written += size
+        count += 1
+
+SHAPES = {
+    "small-text":   lambda root, rand, size: makeFiles(root, rand, DataSource(rand, True), size, 512, 16384, 100),
+    "small-random": lambda root, rand, size: makeFiles(root, rand, DataSource(rand, False), size, 512, 16384, 100),
+    "huge-text":    lambda root, rand, size: makeFiles(root, rand, DataSource(rand, True), size, size // 2, size // 2, 1),
+    "huge-random":  lambda root, rand, size: makeFiles(root, rand, DataSource(rand, False), size, size // 2, size // 2, 1),
+    "deep":         lambda root, rand, size: makeFiles(root, rand, DataSource(rand, True), size, 1024, 65536, 20, 40),
+}
+
+def treeSize(root):
+    ## (files, bytes)
+    files = 0
+    size = 0
+    for (path, dirs, names) in os.walk(root):
+        for name in names:
+            files += 1
+            size += os.lstat(os.path.join(path, name)).st_size
+    return (files, size)
+
+######################################################################
+## runs
+######################################################################
+class Bench(object):
+    def __init__(self, options, work, shape):
+        self.options = options
+        self.work = os.path.join(work, shape)
+        self.shape = shape
+        self.tree = os.path.join(self.work, "tree")
+        self.store = os.path.join(self.work, "bucket")
+        self.results = []
+        os.makedirs(os.path.join(self.work, "dump"))
+        self.script = os.path.join(self.work, "ok.sh")
+        with open(self.script, 'w') as f:
+            f.write("#!/bin/sh\nexit 0\n")
+
+    def run(self, name, args, size=0):
+        ## one run of the backup script in its own process, against the fake bucket
+        report = os.path.join(self.work, "%s.report.json" % name)
+        command = [sys.executable, FAKE_S3, self.store, SCRIPT,
+                   "--log-file", os.path.join(self.work, "backup.log"),
+                   "--s3-backup-bucket", "bench", "--s3-backup-region", "local", "--s3-prefix", PREFIX,
+                   "--dump-dir", os.path.join(self.work, "dump"), "--directory", self.tree,
+                   "--pre-restore-script", self.script, "--post-restore-script", self.script,
+                   "--report-file", report] + shlex.split(self.options.scriptArgs) + args
+        if os.path.exists(os.path.join(self.store, "requests.log")):
+            os.remove(os.path.join(self.store, "requests.log"))
+        started = time.time()
+        with open(os.path.join(self.work, "output.log"), 'a') as output:
+            proc = subprocess.Popen(command, stdout=output, stderr=output)
+            ## wait4 hands back the rusage of the run, its pool processes included
+            (pid, status, usage) = os.wait4(proc.pid, 0)
+        elapsed = time.time() - started
+        if status != 0:
+            sys.exit("[%s] %s failed, see %s" % (self.shape, name, os.path.join(self.work, "output.log")))
+        requests = fakes3.readRequestCounts(self.store)
+        phases = {}
+        if os.path.exists(report):
+            with open(report) as f:
+                phases = dict((phase, totals["seconds"]) for (phase, totals) in json.load(f)["phases"].iteritems())
+        result = {"shape": self.shape, "run": name, "seconds": elapsed, "mbPerSecond": size / max(elapsed, 0.001) / 1048576 if size else None,
+                  "peakRssMb": usage.ru_maxrss / 1024.0, "requests": sum(requests.values()), "requestCounts": requests, "phases": phases}
+        self.results.append(result)
+        return result
+
+    def restore(self, name, args, expected):
+        ## restores into an empty tree and checks that everything came back
+        shutil.rmtree(self.tree)
+        result = self.run(name, ["--restore"] + args, expected[1])
+        if treeSize(self.tree) != expected:
+            sys.exit("[%s] %s restored %s (files, bytes), expected %s" % (self.shape, name, treeSize(self.tree), expected))
+        return result
+
+    def addHistory(self, count):
+        ## copies the one real snapshot to <count> hourly timestamps before it - the archives
+        ## are hard links, only the snapshot.json files are rewritten with their own timestamp
+        objects = os.path.join(self.store, "objects", PREFIX)
+        (latest,) = [name for name in os.listdir(objects) if name[0].isdigit()]
+        newest = datetime.datetime.strptime(latest, "%Y-%m-%d-%H-%M-%S")
+        stamps = []
+        for i in range(1, count + 1):
+            stamp = (newest - datetime.timedelta(hours=i)).strftime("%Y-%m-%d-%H-%M-%S")
+            stamps.append(stamp)
+            for kind in ("objects", "etags"):
+                os.makedirs(os.path.join(self.store, kind, PREFIX, stamp))
+                for member in os.listdir(os.path.join(self.store, kind, PREFIX, latest)):
+                    os.link(os.path.join(self.store, kind, PREFIX, latest, member), os.path.join(self.store, kind, PREFIX, stamp, member))
+            for member in os.listdir(os.path.join(objects, stamp)):
+                if member.endswith(".snapshot.json"):
+                    path = os.path.join(objects, stamp, member)
+                    with open(path) as f:
+                        snapshot = json.load(f)
+                    snapshot["timestamp"] = stamp
+                    os.remove(path)
+                    with open(path, 'w') as f:
+                        json.dump(snapshot, f)
+        return stamps
+
+def runShape(options, work, shape):
+    bench = Bench(options, work, shape)
+    print "[%s] writing %d MB" % (shape, options.size)
+    SHAPES[shape](bench.tree, random.Random(options.seed), options.size * 1048576)
+    expected = treeSize(bench.tree)
+
+    bench.run("backup", [], expected[1])
+    bench.restore("restore", [], expected)
+    stamps = bench.addHistory(options.history)
+    bench.run("rebuild-catalog", ["--rebuild-catalog"])
+    bench.restore("restore-stamp", ["--restore-stamp", stamps[len(stamps) // 2]], expected)
+    ## a second backup, whose cleanup works through the whole history
+    time.sleep(1)
+    bench.run("backup+cleanup", [], expected[1])
+    return bench.results
+
+######################################################################
+## reporting
+######################################################################
+def compare(result, baseline, tolerance):
+    ## the changes against the baseline and whether any of them is a regression
+    if baseline is None:
+        return ("", False)
+    changes = []
+    regressed = False
+    for (key, label) in (("seconds", "time"), ("peakRssMb", "rss")):
+        change = (result[key] - baseline[key]) / max(baseline[key], 0.001)
+        changes.append("%s %+.0f%%" % (label, 100 * change))
+        regressed = regressed or change > tolerance
+    changes.append("requests %+d" % (result["requests"] - baseline["requests"]))
+    regressed = regressed or result["requests"] > baseline["requests"]
+    return (", ".join(changes), regressed)
+
+def main():
+    options = parseArgs()
+    for shape in options.shapes.split(","):
+        if shape not in SHAPES:
+            sys.exit("unknown shape [%s], pick from %s" % (shape, ", ".join(sorted(SHAPES))))
+    baseline = {}
+    if options.baseline and os.path.exists(options.baseline):
+        with open(options.baseline) as f:
+            baseline = dict(("%s/%s" % (result["shape"], result["run"]), result) for result in json.load(f)["results"])
+
+    work = options.workDir or tempfile.mkdtemp(prefix="backup-benchmark-")
+    results = []
+    try:
+        for shape in options.shapes.split(","):
+            results += runShape(options, work, shape)
+    finally:
+        if options.keep or options.workDir:
+            print "work dir: %s" % work
+        else:
+            shutil.rmtree(work, ignore_errors=True)
+
+    regressions = 0
+    print "%-13s %-16s %9s %9s %9s %9s  %s" % ("shape", "run", "seconds", "MB/s", "rss MB", "requests", "against the baseline")
+    for result in results:
+        (changes, regressed) = compare(result, baseline.get("%s/%s" % (result["shape"], result["run"])), options.tolerance)
+        regressions += regressed
+        mbPerSecond = "%9.2f" % result["mbPerSecond"] if result["mbPerSecond"] is not None else "%9s" % "-"
+        print "%-13s %-16s %9.2f %s %9.1f %9d  %s%s" % (result["shape"], result["run"], result["seconds"], mbPerSecond, result["peakRssMb"], result["requests"], changes, " REGRESSED" if regressed else "")
+        if result["run"] == "backup+cleanup" and "cleanup" in result["phases"]:
+            print "%-13s %-16s %9.2f" % ("", "  of it cleanup", result["phases"]["cleanup"])
+
+    if options.saveBaseline:
+        with open(options.saveBaseline, 'w') as f:
+            json.dump({"version": 1, "created": datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S"), "size": options.size,
+                       "history": options.history, "scriptArgs": options.scriptArgs, "results": results}, f, indent=2, sort_keys=True)
+        print "saved the baseline to [%s]" % options.saveBaseline
+    if regressions:
+        sys.exit("%d runs regressed against the baseline" % regressions)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+######################################################################
+## Compares the codecs of cloudcoreo-directory-backup.py on a directory
+## of your own - compression ratio against throughput, with and without
+## --adaptive-compression. The archives are thrown away, nothing is
+## written to disk or sent to s3
+##   example:
+##       python benchmarks/codec-benchmark.py /var/lib/data \
+##              --codecs gzip:1,gzip:6,zstd:3,lz4:0 \
+##              --threads 4
+##
+######################################################################
+import os
+import imp
+import time
+import argparse
+import tarfile
+import multiprocessing
+from contextlib import closing
+
+backup = imp.load_source("backup", os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "cloudcoreo-directory-backup.py"))
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Compare the compression ratio and throughput of every codec on a directory")
+    parser.add_argument("directory",                                                                          help="The directory to archive")
+    parser.add_argument("--codecs",            dest="codecs",                                              default="none:0,gzip:1,gzip:6,gzip:9,zstd:1,zstd:3,zstd:9,lz4:0,lz4:9", help="A CSV of codec:level to try - codecs whose module isn't installed are skipped")
+    parser.add_argument("--threads",           dest="threads",           type=int, default=multiprocessing.cpu_count(), help="How many threads compress each archive")
+    parser.add_argument("--repeat",            dest="repeat",            type=int, default=1,              help="How many times to archive with each codec - the best run is reported")
+    return parser.parse_args()
+
+class NullWriter(object):
+    ## counts what the compressor writes and drops it
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+def archive(directory, codec, level, threads, adaptive):
+    out = NullWriter()
+    writer = backup.ParallelCompressWriter(out, threads, codec, level)
+    started = time.time()
+    with closing(backup.IndexedTarFile.open(fileobj=writer, mode="w")) as tar:
+        if adaptive:
+            tar.compressor = writer
+        tar.add(directory, arcname=os.path.basename(directory))
+    writer.close()
+    return (writer.size, out.size, writer.storedSize, time.time() - started)
+
+def main():
+    options = parseArgs()
+    runs = []
+    for spec in options.codecs.split(","):
+        (name, level) = spec.split(":")
+        codec = backup.CODECS[name]
+        if (name == "zstd" and backup.zstandard is None) or (name == "lz4" and backup.lz4frame is None):
+            print "skipping %s, the %s module isn't installed" % (name, codec.module)
+            continue
+        runs.append((codec, int(level), False))
+        if codec.storeLevel != int(level):
+            runs.append((codec, int(level), True))
+
+    ## one untimed pass so every run reads the files from the page cache
+    archive(options.directory, backup.CODECS["none"], 0, 1, False)
+
+    print "%-6s %5s %8s %12s %12s %7s %12s %9s" % ("codec", "level", "adaptive", "size", "compressed", "ratio", "stored", "MB/s")
+    for (codec, level, adaptive) in runs:
+        best = None
+        for i in range(options.repeat):
+            result = archive(options.directory, codec, level, options.threads, adaptive)
+            if best is None or result[3] < best[3]:
+                best = result
+        (size, compressed, stored, elapsed) = best
+        print "%-6s %5d %8s %12d %12d %6.1f%% %12d %9.2f" % (codec.name, level, "yes" if adaptive else "no", size, compressed, 100.0 * compressed / max(size, 1), stored, size / max(elapsed, 0.000001) / 1048576)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+######################################################################
+## A local stand-in for the parts of s3 cloudcoreo-directory-backup.py
+## uses, kept in a directory so every process of a run (the compress
+## pool included) sees the same bucket. Every request is appended to
+## <store>/requests.log, one line per request.
+##   example (runs the backup against the store instead of s3):
+##       python benchmarks/fakes3.py /tmp/fake-bucket \
+##              cloudcoreo-directory-backup.py \
+##              --s3-backup-bucket fake --s3-backup-region local \
+##              --s3-prefix backups --directory /var/lib/data
+##
+######################################################################
+import os
+import sys
+import uuid
+import base64
+import shutil
+import hashlib
+import tempfile
+import boto
+import boto.s3
+import boto.s3.multipart
+import boto.exception
+
+STORE = None
+REQUEST_LOG = None
+
+def install(store):
+    ## point boto at the store - must run before the backup script is loaded
+    global STORE
+    STORE = os.path.abspath(store)
+    for name in ("objects", "etags", "uploads"):
+        if not os.path.isdir(os.path.join(STORE, name)):
+            os.makedirs(os.path.join(STORE, name))
+    boto.s3.connect_to_region = lambda region, **kwargs: FakeConnection()
+    boto.s3.multipart.MultiPartUpload = FakeMultiPartUpload
+
+def countRequest(kind):
+    ## one write per request with O_APPEND, so the lines of concurrent processes don't mix
+    global REQUEST_LOG
+    if REQUEST_LOG is None or REQUEST_LOG[0] != os.getpid():
+        REQUEST_LOG = (os.getpid(), os.open(os.path.join(STORE, "requests.log"), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644))
+    os.write(REQUEST_LOG[1], kind + "\n")
+
+def readRequestCounts(store):
+    counts = {}
+    path = os.path.join(store, "requests.log")
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                counts[line.strip()] = counts.get(line.strip(), 0) + 1
+    return counts
+
+def objectPath(name):
+    return os.path.join(STORE, "objects", name)
+
+def writeObject(name, source, etag=None):
+    ## written to a temp file and renamed into place, so readers see the old or the new object
+    digest = hashlib.md5()
+    (fd, temp) = tempfile.mkstemp(dir=os.path.join(STORE, "uploads"))
+    with os.fdopen(fd, 'wb') as f:
+        for data in source:
+            digest.update(data)
+            f.write(data)
+    for path in (os.path.join(STORE, "etags", name), objectPath(name)):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+    with open(os.path.join(STORE, "etags", name), 'w') as f:
+        f.write(etag or digest.hexdigest())
+    os.rename(temp, objectPath(name))
+
+def readBlocks(fileobj, size=None):
+    while size is None or size > 0:
+        data = fileobj.read(1048576 if size is None else min(size, 1048576))
+        if not data:
+            break
+        if size is not None:
+            size -= len(data)
+        yield data
+
+def readPart(path):
+    with open(path, 'rb') as f:
+        for data in readBlocks(f):
+            yield data
+
+def checkMd5(data, md5):
+    ## boto hands over (hex digest, base64 digest) for Content-MD5
+    if md5 is not None and base64.b64encode(hashlib.md5(data).digest()) != md5[1]:
+        raise boto.exception.S3ResponseError(400, "BadDigest", "The Content-MD5 you specified did not match what was received.")
+
+class FakeKey(object):
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    @property
+    def size(self):
+        return os.path.getsize(objectPath(self.name))
+
+    @property
+    def etag(self):
+        with open(os.path.join(STORE, "etags", self.name)) as f:
+            return '"%s"' % f.read()
+
+    def get_contents_as_string(self, headers=None):
+        countRequest("GET")
+        with open(objectPath(self.name), 'rb') as f:
+            if headers and "Range" in headers:
+                (start, end) = headers["Range"].split("=")[1].split("-")
+                f.seek(int(start))
+                return f.read(int(end) - int(start) + 1)
+            return f.read()
+
+    def set_contents_from_string(self, data, headers=None, md5=None, **kwargs):
+        countRequest("PUT")
+        checkMd5(data, md5)
+        writeObject(self.name, [data])
+
+    def set_contents_from_filename(self, filename, headers=None, md5=None, **kwargs):
+        countRequest("PUT")
+        with open(filename, 'rb') as f:
+            checkMd5(f.read(), md5)
+            f.seek(0)
+            writeObject(self.name, readBlocks(f))
+
+class FakeBucket(object):
+    def __init__(self, name):
+        self.name = name
+
+    def list(self, prefix="", delimiter=""):
+        ## one request per 1000 keys, like the real listing
+        names = []
+        for (root, dirs, files) in os.walk(os.path.join(STORE, "objects")):
+            for filename in files:
+                name = os.path.relpath(os.path.join(root, filename), os.path.join(STORE, "objects"))
+                if name.startswith(prefix):
+                    names.append(name)
+        names.sort()
+        for i in range(0, max(len(names), 1), 1000):
+            countRequest("LIST")
+            for name in names[i:i + 1000]:
+                yield FakeKey(self, name)
+
+    def get_key(self, name, **kwargs):
+        countRequest("HEAD")
+        if os.path.isfile(objectPath(name)):
+            return FakeKey(self, name)
+        return None
+
+    def new_key(self, name):
+        return FakeKey(self, name)
+
+    def delete_keys(self, names, quiet=False, **kwargs):
+        countRequest("DELETE")
+        if len(names) > 1000:
+            raise boto.exception.S3ResponseError(400, "MalformedXML", "more than 1000 keys in one delete")
+        for name in names:
+            for path in (objectPath(name), os.path.join(STORE, "etags", name)):
+                if os.path.exists(path):
+                    os.remove(path)
+        return FakeDeleteResult()
+
+    def initiate_multipart_upload(self, name, **kwargs):
+        countRequest("INITIATE")
+        mp = FakeMultiPartUpload(self)
+        mp.key_name = name
+        mp.id = uuid.uuid4().hex
+        os.makedirs(os.path.join(STORE, "uploads", mp.id))
+        return mp
+
+class FakeDeleteResult(object):
+    def __init__(self):
+        self.errors = []
+
+class FakeMultiPartUpload(object):
+    ## parts are files under <store>/uploads/<id>, so any connection can add to an upload
+    def __init__(self, bucket=None):
+        self.bucket = bucket
+        self.key_name = None
+        self.id = None
+
+    def upload_part_from_file(self, fp, part_num, size=None, md5=None, **kwargs):
+        countRequest("UPLOAD_PART")
+        data = "".join(readBlocks(fp, size))
+        checkMd5(data, md5)
+        with open(os.path.join(STORE, "uploads", self.id, "%05d" % part_num), 'wb') as f:
+            f.write(data)
+
+    def complete_upload(self):
+        ## the etag of a multipart object is the md5 of the md5s of its parts, like s3's
+        countRequest("COMPLETE")
+        parts = os.path.join(STORE, "uploads", self.id)
+        names = sorted(os.listdir(parts))
+        digests = "".join(hashlib.md5("".join(readPart(os.path.join(parts, part)))).digest() for part in names)
+        etag = "%s-%d" % (hashlib.md5(digests).hexdigest(), len(names))
+        writeObject(self.key_name, (data for part in names for data in readPart(os.path.join(parts, part))), etag)
+        shutil.rmtree(parts)
+        return FakeCompleteUpload(self.bucket, self.key_name, etag)
+
+    def cancel_upload(self):
+        countRequest("ABORT")
+        shutil.rmtree(os.path.join(STORE, "uploads", self.id), ignore_errors=True)
+
+class FakeCompleteUpload(object):
+    def __init__(self, bucket, key_name, etag):
+        self.bucket = bucket
+        self.key_name = key_name
+        self.etag = '"%s"' % etag
+
+class FakeConnection(object):
+    def get_bucket(self, name, validate=True):
+        return FakeBucket(name)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        sys.exit("usage: %s <store directory> <script> [script arguments]" % sys.argv[0])
+    ## the script runs as the real __main__ module, so the pool processes can unpickle
+    ## its functions - the stand-in is imported on its own so the script can't clobber it
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import fakes3
+    fakes3.install(sys.argv[1])
+    sys.argv = sys.argv[2:]
+    import __main__
+    __main__.__file__ = sys.argv[0]
+    execfile(sys.argv[0], __main__.__dict__)
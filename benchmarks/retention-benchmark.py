@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+######################################################################
+## Times the cleanup planner of cloudcoreo-directory-backup.py against
+## a simulated history of snapshots - nothing is sent to s3
+##   example:
+##       python benchmarks/retention-benchmark.py \
+##              --snapshots 100000 \
+##              --keys-per-snapshot 3 \
+##              --rolling-pattern 24,7,5,12,5
+##
+######################################################################
+import os
+import imp
+import time
+import math
+import datetime
+import argparse
+
+backup = imp.load_source("backup", os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "cloudcoreo-directory-backup.py"))
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Time the retention planner against a simulated snapshot history")
+    parser.add_argument("--snapshots",         dest="snapshots",         type=int, default=100000,         help="How many snapshots to simulate, one per --interval-minutes")
+    parser.add_argument("--keys-per-snapshot", dest="keysPerSnapshot",   type=int, default=3,              help="How many keys (archives, indexes...) every snapshot has")
+    parser.add_argument("--interval-minutes",  dest="intervalMinutes",   type=int, default=60,             help="How far apart the simulated snapshots are")
+    parser.add_argument("--rolling-pattern",   dest="rollingPattern",              default="24,7,5,12,5",  help="The --rolling-pattern to plan with")
+    parser.add_argument("--repeat",            dest="repeat",            type=int, default=3,              help="How many times to plan - the best run is reported")
+    return parser.parse_args()
+
+def simulateListing(snapshots, keysPerSnapshot, intervalMinutes):
+    ## newest first, the same order the bucket listing is handed to the planner in
+    now = datetime.datetime(2026, 1, 1)
+    names = []
+    for i in xrange(snapshots):
+        timestamp = (now - datetime.timedelta(minutes=i * intervalMinutes)).strftime("%Y-%m-%d-%H-%M-%S")
+        for k in xrange(keysPerSnapshot):
+            names.append("backups/%s/_data_%d.tar.gz" % (timestamp, k))
+    return names
+
+def main():
+    options = parseArgs()
+    started = time.time()
+    names = simulateListing(options.snapshots, options.keysPerSnapshot, options.intervalMinutes)
+    print "simulated %d keys in %d snapshots in %.2fs" % (len(names), options.snapshots, time.time() - started)
+
+    best = None
+    for i in range(options.repeat):
+        started = time.time()
+        plan = backup.planRetention(names, options.rollingPattern)
+        elapsed = time.time() - started
+        if best is None or elapsed < best:
+            best = elapsed
+
+    deleteKeys = sum(len(keys) for keys in plan["delete"].itervalues())
+    print "planned in %.3fs (%.0f keys/s)" % (best, len(names) / max(best, 0.000001))
+    print "keep %d snapshots, delete %d snapshots (%d keys in %d delete requests)" % (len(plan["keep"]), len(plan["delete"]), deleteKeys, int(math.ceil(deleteKeys / 1000.0)))
+
+if __name__ == "__main__":
+    main()
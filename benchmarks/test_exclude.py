@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+######################################################################
+## Checks the --exclude and --exclude-glob matching of
+## cloudcoreo-directory-backup.py
+##   example:
+##       python -m unittest discover -s benchmarks -p "test_*.py"
+##
+######################################################################
+import os
+import re
+import imp
+import unittest
+
+backup = imp.load_source("backup", os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "cloudcoreo-directory-backup.py"))
+
+def globMatches(glob, value):
+    return re.match("(?:%s)\\Z" % backup.globToRegex(glob), value) is not None
+
+def excluded(matcher, relpath, isDir=False):
+    return matcher.excluded("/data/" + relpath, relpath, os.path.basename(relpath), isDir)
+
+class GlobToRegexTest(unittest.TestCase):
+    def test_star_stays_within_a_component(self):
+        self.assertTrue(globMatches("*.log", "app.log"))
+        self.assertFalse(globMatches("*.log", "logs/app.log"))
+        self.assertTrue(globMatches("logs/*", "logs/app.log"))
+        self.assertFalse(globMatches("logs/*", "logs/old/app.log"))
+
+    def test_question_mark_and_classes(self):
+        self.assertTrue(globMatches("app.?", "app.1"))
+        self.assertFalse(globMatches("app.?", "app.10"))
+        self.assertFalse(globMatches("app.?", "app/"))
+        self.assertTrue(globMatches("app.[0-9]", "app.7"))
+        self.assertFalse(globMatches("app.[!0-9]", "app.7"))
+        self.assertTrue(globMatches("app.[!0-9]", "app.x"))
+
+    def test_double_star(self):
+        self.assertTrue(globMatches("**/cache", "cache"))
+        self.assertTrue(globMatches("**/cache", "a/b/cache"))
+        self.assertFalse(globMatches("**/cache", "a/mycache"))
+        self.assertTrue(globMatches("logs/**", "logs/a/b.log"))
+        self.assertTrue(globMatches("a/**/z", "a/z"))
+        self.assertTrue(globMatches("a/**/z", "a/b/c/z"))
+
+    def test_special_characters_are_literal(self):
+        self.assertTrue(globMatches("a+b(1).txt", "a+b(1).txt"))
+        self.assertFalse(globMatches("a.txt", "abtxt"))
+
+class ExcludeMatcherTest(unittest.TestCase):
+    def test_names_match_at_any_depth(self):
+        matcher = backup.ExcludeMatcher([], ["*.tmp"])
+        self.assertTrue(excluded(matcher, "a.tmp"))
+        self.assertTrue(excluded(matcher, "sub/dir/a.tmp"))
+        self.assertFalse(excluded(matcher, "a.tmp.keep"))
+
+    def test_a_slash_anchors_to_the_top(self):
+        matcher = backup.ExcludeMatcher([], ["build/*.o", "/cache"])
+        self.assertTrue(excluded(matcher, "build/a.o"))
+        self.assertFalse(excluded(matcher, "src/build/a.o"))
+        self.assertTrue(excluded(matcher, "cache", True))
+        self.assertFalse(excluded(matcher, "sub/cache", True))
+
+    def test_trailing_slash_only_matches_directories(self):
+        matcher = backup.ExcludeMatcher([], ["tmp/", "var/run/"])
+        self.assertTrue(excluded(matcher, "tmp", True))
+        self.assertTrue(excluded(matcher, "sub/tmp", True))
+        self.assertFalse(excluded(matcher, "sub/tmp", False))
+        self.assertTrue(excluded(matcher, "var/run", True))
+        self.assertFalse(excluded(matcher, "var/run", False))
+
+    def test_double_star_paths(self):
+        matcher = backup.ExcludeMatcher([], ["**/node_modules/", "logs/**/*.gz"])
+        self.assertTrue(excluded(matcher, "node_modules", True))
+        self.assertTrue(excluded(matcher, "web/app/node_modules", True))
+        self.assertTrue(excluded(matcher, "logs/2026/01/app.gz"))
+        self.assertTrue(excluded(matcher, "logs/app.gz"))
+        self.assertFalse(excluded(matcher, "old/logs/app.gz"))
+
+    def test_regexes_match_the_full_path_from_the_start(self):
+        matcher = backup.ExcludeMatcher(["/data/cache/"], [])
+        self.assertTrue(excluded(matcher, "cache/a"))
+        self.assertFalse(excluded(matcher, "sub/cache/a"))
+
+    def test_nothing_to_exclude(self):
+        matcher = backup.ExcludeMatcher([], [])
+        self.assertFalse(excluded(matcher, "a.tmp"))
+        self.assertFalse(excluded(matcher, "tmp", True))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+######################################################################
+## Checks the checksums cloudcoreo-directory-backup.py takes while it
+## archives - nothing is sent to s3
+##   example:
+##       python -m unittest discover -s benchmarks -p "test_*.py"
+##
+######################################################################
+import os
+import imp
+import shutil
+import hashlib
+import tempfile
+import unittest
+from contextlib import closing
+from cStringIO import StringIO
+
+backup = imp.load_source("backup", os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "cloudcoreo-directory-backup.py"))
+
+class DigestWriterTest(unittest.TestCase):
+    def write(self, data, partSize, pieces):
+        out = StringIO()
+        writer = backup.DigestWriter(out, partSize)
+        for i in range(0, len(data), pieces):
+            writer.write(data[i:i + pieces])
+        writer.finish()
+        self.assertEqual(out.getvalue(), data)
+        return writer
+
+    def test_parts_line_up_however_the_data_is_written(self):
+        data = os.urandom(2500)
+        for pieces in (1, 7, 1000, 5000):
+            writer = self.write(data, 1000, pieces)
+            self.assertEqual(writer.parts, [hashlib.md5(data[i:i + 1000]).hexdigest() for i in (0, 1000, 2000)])
+            self.assertEqual(writer.sha256.hexdigest(), hashlib.sha256(data).hexdigest())
+
+    def test_an_empty_archive_has_one_empty_part(self):
+        writer = self.write("", 1000, 1)
+        self.assertEqual(writer.parts, [hashlib.md5("").hexdigest()])
+
+    def test_etags(self):
+        data = os.urandom(2000)
+        writer = self.write(data, 1000, 300)
+        parts = "".join(hashlib.md5(data[i:i + 1000]).digest() for i in (0, 1000))
+        self.assertEqual(writer.summary("a", True)["etag"], "%s-2" % hashlib.md5(parts).hexdigest())
+        small = self.write(data[:10], 1000, 3)
+        self.assertEqual(small.summary("a", False)["etag"], hashlib.md5(data[:10]).hexdigest())
+
+    def test_content_md5(self):
+        digest = hashlib.md5("abc")
+        self.assertEqual(backup.contentMd5(digest.hexdigest()), (digest.hexdigest(), digest.digest().encode("base64").strip()))
+
+class ArchiveDigestsTest(unittest.TestCase):
+    def setUp(self):
+        self.work = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work)
+
+    def test_every_file_and_hard_link_gets_its_sha256(self):
+        directory = os.path.join(self.work, "data")
+        os.makedirs(directory)
+        with open(os.path.join(directory, "a.txt"), 'wb') as f:
+            f.write("a" * 100000)
+        os.link(os.path.join(directory, "a.txt"), os.path.join(directory, "b.txt"))
+        with closing(backup.IndexedTarFile.open(fileobj=StringIO(), mode="w")) as tar:
+            tar.digests = {}
+            for name in ("", "a.txt", "b.txt"):
+                tar.add(os.path.join(directory, name), arcname=os.path.join("data", name).rstrip("/"), recursive=False)
+        expected = hashlib.sha256("a" * 100000).hexdigest()
+        self.assertEqual(tar.digests, {"data/a.txt": expected, "data/b.txt": expected})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+######################################################################
+## Checks the cleanup planner of cloudcoreo-directory-backup.py -
+## nothing is sent to s3
+##   example:
+##       python -m unittest discover -s benchmarks -p "test_*.py"
+##
+######################################################################
+import os
+import imp
+import unittest
+
+backup = imp.load_source("backup", os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "cloudcoreo-directory-backup.py"))
+
+def listing(*timestamps):
+    return ["backups/%s/_data.tar.gz" % timestamp for timestamp in timestamps]
+
+class BucketSnapshotsTest(unittest.TestCase):
+    def test_newest_snapshot_of_every_slot(self):
+        buckets = backup.bucketSnapshots(["backups/2026-01-14-10-30-00", "backups/2026-01-14-10-00-00",
+                                          "backups/2026-01-14-09-00-00", "backups/2026-01-13-23-00-00"])
+        self.assertEqual(buckets["hourly"], ["backups/2026-01-14-10-30-00", "backups/2026-01-14-09-00-00", "backups/2026-01-13-23-00-00"])
+        self.assertEqual(buckets["daily"], ["backups/2026-01-14-10-30-00", "backups/2026-01-13-23-00-00"])
+        self.assertEqual(buckets["monthly"], ["backups/2026-01-14-10-30-00"])
+        self.assertEqual(buckets["yearly"], ["backups/2026-01-14-10-30-00"])
+
+    def test_weekly_only_on_multiples_of_seven(self):
+        buckets = backup.bucketSnapshots(["backups/2026-01-15-00-00-00", "backups/2026-01-14-00-00-00", "backups/2026-01-07-00-00-00"])
+        self.assertEqual(buckets["weekly"], ["backups/2026-01-14-00-00-00", "backups/2026-01-07-00-00-00"])
+
+    def test_no_snapshots(self):
+        self.assertEqual(backup.bucketSnapshots([]), dict((interval, []) for interval in backup.RETENTION_INTERVALS))
+
+class PlanRetentionTest(unittest.TestCase):
+    def test_keeps_the_newest_of_every_kind(self):
+        names = listing("2026-01-14-12-00-00", "2026-01-14-11-00-00", "2026-01-14-10-00-00", "2026-01-13-12-00-00")
+        plan = backup.planRetention(names, "2,1,0,0,0")
+        self.assertEqual(plan["keep"], ["backups/2026-01-14-12-00-00", "backups/2026-01-14-11-00-00"])
+        self.assertEqual(sorted(plan["delete"]), ["backups/2026-01-13-12-00-00", "backups/2026-01-14-10-00-00"])
+
+    def test_deletes_every_key_of_a_snapshot(self):
+        names = ["backups/2026-01-14-12-00-00/_data.tar.gz", "backups/2026-01-13-12-00-00/_data.tar.gz",
+                 "backups/2026-01-13-12-00-00/_data.snapshot.json", "backups/2026-01-13-12-00-00/_data.offsets.json.gz"]
+        plan = backup.planRetention(names, "1,0,0,0,0")
+        self.assertEqual(sorted(plan["delete"]["backups/2026-01-13-12-00-00"]), sorted(names[1:]))
+
+    def test_keeps_the_snapshots_an_incremental_depends_on(self):
+        names = listing("2026-01-14-12-00-00", "2026-01-14-11-00-00", "2026-01-14-10-00-00", "2026-01-14-09-00-00")
+        chains = {"backups/2026-01-14-12-00-00": ["backups/2026-01-14-10-00-00", "backups/2026-01-14-11-00-00"]}
+        plan = backup.planRetention(names, "1,0,0,0,0", lambda prefix, keyNames: chains.get(prefix, []))
+        self.assertEqual(plan["keep"], ["backups/2026-01-14-12-00-00", "backups/2026-01-14-11-00-00", "backups/2026-01-14-10-00-00"])
+        self.assertEqual(sorted(plan["delete"]), ["backups/2026-01-14-09-00-00"])
+
+    def test_ignores_dependencies_that_are_already_gone(self):
+        names = listing("2026-01-14-12-00-00")
+        plan = backup.planRetention(names, "1,0,0,0,0", lambda prefix, keyNames: ["backups/2026-01-14-08-00-00"])
+        self.assertEqual(plan["keep"], ["backups/2026-01-14-12-00-00"])
+        self.assertEqual(plan["delete"], {})
+
+if __name__ == "__main__":
+    unittest.main()
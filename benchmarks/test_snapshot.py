@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+######################################################################
+## Checks the --snapshot hardlink stage of
+## cloudcoreo-directory-backup.py on a temporary directory - nothing
+## is sent to s3
+##   example:
+##       python -m unittest discover -s benchmarks -p "test_*.py"
+##
+######################################################################
+import os
+import imp
+import shutil
+import tempfile
+import unittest
+
+backup = imp.load_source("backup", os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "cloudcoreo-directory-backup.py"))
+
+def writeFile(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+class HardlinkSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.work = tempfile.mkdtemp()
+        self.directory = os.path.join(self.work, "data")
+        os.makedirs(os.path.join(self.directory, "sub"))
+        writeFile(os.path.join(self.directory, "a.txt"), "a")
+        writeFile(os.path.join(self.directory, "sub", "b.txt"), "b")
+        writeFile(os.path.join(self.directory, "skip.tmp"), "tmp")
+        backup.options = backup.parseArgs(["--log-file", os.path.join(self.work, "backup.log"), "--exclude-glob", "*.tmp",
+                                           "--snapshot", "hardlink", "--snapshot-dir", os.path.join(self.work, "snapshots")])
+        backup.EXCLUDE_MATCHER = None
+
+    def tearDown(self):
+        backup.releaseSnapshots()
+        shutil.rmtree(self.work)
+
+    def test_entries_keep_the_original_names(self):
+        backup.takeSnapshots([self.directory])
+        root = os.path.join(self.work, "snapshots", backup.archiveName(self.directory))
+        entries = backup.scanDirectory(self.directory)
+        self.assertEqual([arcname for (path, arcname, st) in entries], ["data", "data/a.txt", "data/sub", "data/sub/b.txt"])
+        self.assertEqual([path for (path, arcname, st) in entries],
+                         [root, os.path.join(root, "a.txt"), os.path.join(root, "sub"), os.path.join(root, "sub", "b.txt")])
+        self.assertEqual(os.stat(os.path.join(root, "a.txt")).st_ino, os.stat(os.path.join(self.directory, "a.txt")).st_ino)
+
+    def test_files_written_to_after_the_snapshot_are_caught(self):
+        backup.takeSnapshots([self.directory])
+        root = os.path.join(self.work, "snapshots", backup.archiveName(self.directory))
+        with open(os.path.join(root, "a.txt"), 'rb') as f:
+            self.assertFalse(backup.changedSinceSnapshot(self.directory, "data/a.txt", f))
+        with open(os.path.join(self.directory, "a.txt"), 'ab') as f:
+            f.write("more")
+        with open(os.path.join(root, "a.txt"), 'rb') as f:
+            self.assertTrue(backup.changedSinceSnapshot(self.directory, "data/a.txt", f))
+
+    def test_released_snapshots_are_removed(self):
+        backup.takeSnapshots([self.directory])
+        backup.releaseSnapshots()
+        self.assertEqual(os.listdir(os.path.join(self.work, "snapshots")), [])
+        self.assertTrue(os.path.isfile(os.path.join(self.directory, "a.txt")))
+        self.assertEqual(backup.scanDirectory(self.directory)[0][0], self.directory)
+
+    def test_the_snapshot_cannot_go_inside_the_directory(self):
+        backup.options.snapshotDir = os.path.join(self.directory, "snapshots")
+        self.assertRaises(Exception, backup.takeSnapshots, [self.directory])
+
+if __name__ == "__main__":
+    unittest.main()
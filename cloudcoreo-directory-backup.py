@@ -26,6 +26,7 @@ from filechunkio import FileChunkIO
 import string
 import tarfile
 import boto
+import boto.utils
 from boto.s3.connection import OrdinaryCallingFormat
 import datetime
 import subprocess
@@ -36,13 +37,121 @@ from optparse import OptionParser
 import argparse
 import textwrap
 from contextlib import closing
+from cStringIO import StringIO
 from datetime import timedelta
 import re
+import traceback
+import threading
+import Queue
+import time
+import zlib
+import struct
+import collections
+import multiprocessing
+import json
+import hashlib
+import shutil
+import bisect
+import errno
+import atexit
+import socket
+import signal
+import SocketServer
+import fcntl
+import pwd
+import grp
+import base64
+import binascii
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+from multiprocessing.pool import ThreadPool
+from boto.s3.multipart import MultiPartUpload
 
 version = '0.0.11'
 
+## every block is compressed on its own so the blocks can be compressed in parallel
+COMPRESS_BLOCK_SIZE = 1048576
+GZIP_HEADER = "\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+
+## with --adaptive-compression, files of at least this size are sampled and stored at the
+## codec's store level when the sample doesn't compress below this ratio
+ADAPTIVE_MIN_SIZE = 262144
+ADAPTIVE_SAMPLE_SIZE = 65536
+ADAPTIVE_STORE_RATIO = 0.95
+
+## restores download archives in ranges of this size, a few ranges ahead of the extraction
+RESTORE_RANGE_SIZE = 16777216
+
+## random (but fixed) values the content defined chunking rolls its hash with
+GEAR = [struct.unpack("<I", hashlib.md5(chr(i)).digest()[:4])[0] for i in range(256)]
+
+## the kinds of snapshots retention keeps, in the order --rolling-pattern lists them
+RETENTION_INTERVALS = ["hourly", "daily", "weekly", "monthly", "yearly"]
+
+## directories with at least this many entries have them stat'ed from the scan threads
+SCAN_PARALLEL_THRESHOLD = 64
+
+## the resource governor checks the load, the disks and the memory this often, never
+## throttles a rate below GOVERNOR_MIN_RATE and holds reads back for at most
+## MEMORY_WAIT_LIMIT seconds at a time while the memory is above --memory-limit
+GOVERNOR_INTERVAL = 2.0
+GOVERNOR_MIN_RATE = 1048576
+MEMORY_WAIT_LIMIT = 30
+## stat'ing an entry is charged to --read-limit as a read of this many bytes
+SCAN_ENTRY_COST = 4096
+
+## how --snapshot can take a point in time copy of the directories
+SNAPSHOT_METHODS = ["none", "auto", "reflink", "hardlink", "hook"]
+## --verify hands the files to its hashing processes this many at a time
+VERIFY_BATCH = 16
+
+## the FICLONE ioctl - a copy on write clone of a whole file (btrfs, xfs)
+FICLONE = 0x40049409
+
+## cached handles - looking up the bucket is a round trip, so do it once per connection
+MY_AZ = None
+BACKUP_BUCKET = None
+CATALOG = None
+EXCLUDE_MATCHER = None
+DOWNLOAD_POOL = None
+UPLOAD_POOL = None
+GOVERNOR = None
+## directory -> the LocalSnapshot its archive is made from during a backup
+SNAPSHOTS = {}
+## local archive -> the digests taken while it was written, for its upload
+ARCHIVE_DIGESTS = {}
+BUCKET_LOCK = threading.Lock()
+THREAD_STATE = threading.local()
+
+## log lines are buffered up to this size (or this many seconds) before they are written
+LOG_BUFFER_SIZE = 65536
+LOG_FLUSH_INTERVAL = 1.0
+LOG_LOCK = threading.Lock()
+LOG_BUFFER = []
+LOG_BUFFERED = 0
+LOG_FLUSHED = time.time()
+LOG_FD = None
+LOG_REOPEN = False
+
 logging.basicConfig()
-def parseArgs():
+def parseArgs(args=None):
     parser = argparse.ArgumentParser(
         prog='manage-icbackend.py',
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -72,40 +181,376 @@ def parseArgs():
     parser.add_argument("--s3-prefix",               dest="s3Prefix",                                    default=None,                                       required=False, help="The key prefix in s3... this will be <key>/<timestamp>/ [default: %default]")
     parser.add_argument("--directory",               dest="backupDirectories",     action="append",      default=[],                                         required=False, help="Specified one or more times to determine which directories must be backed up")
     parser.add_argument("--exclude",                 dest="excludes",              action="append",      default=[],                                         required=False, help="Patterns to exclude")
+    parser.add_argument("--exclude-glob",            dest="excludeGlobs",          action="append",      default=[],                                         required=False, help="Gitignore style patterns to exclude: 'name' matches at any depth, 'a/b' and '/a' match from the top of the directory, a trailing / only matches directories and ** matches across directories")
+    parser.add_argument("--scan-threads",            dest="scanThreads",           type=int,             default=4,                                          required=False, help="How many threads stat the entries of large directories while scanning [default: %default]")
     parser.add_argument("--pre-backup-script",       dest="preBackupScript",                             default=None,                                       required=False, help="A script to run blindly (./<script>) before tar-gzipping the backup directories")
-    parser.add_argument("--post-backup-script",      dest="postBackupScript",                            default=None,                                       required=False, help="A script to run blindly (./<script>) after tar-gzipping the backup directories, but before syncing to s3")
+    parser.add_argument("--post-backup-script",      dest="postBackupScript",                            default=None,                                       required=False, help="A script to run blindly (./<script>) after tar-gzipping the backup directories, but before syncing to s3 (with --snapshot, as soon as the snapshots are taken)")
+    parser.add_argument("--snapshot",                dest="snapshot",              choices=SNAPSHOT_METHODS, default="none",                               required=False, help="Archive a point in time copy of every directory, taken right after the pre backup script, so the post backup script can run as soon as it exists instead of after archiving: reflink (copy on write clones, needs btrfs or xfs), hardlink (a tree of hard links - files written to in place before they are archived are logged as changed), auto (reflinks where the filesystem has them, hard links otherwise) or hook (made by --snapshot-script, e.g. with lvm or btrfs) [default: %default]")
+    parser.add_argument("--snapshot-dir",            dest="snapshotDir",                                 default=None,                                       required=False, help="Where the snapshot of every directory goes (<dir>/<archive name>) - reflinks and hard links need it on the same filesystem as the directories [default: .<name>.snapshot next to every directory]")
+    parser.add_argument("--snapshot-script",         dest="snapshotScript",                              default=None,                                       required=False, help="With --snapshot hook, run as <script> create <directory> <path> to make a snapshot of the directory appear at <path>, and as <script> release <directory> <path> once it has been archived")
     parser.add_argument("--rolling-pattern",         dest="rollingPattern",                              default="24,7,5,12,5",                              required=False, help="A CSV of how many backups of each type to keep. I.E 24,7,5,12,5 will keep 24 hourly, 7 daily, 5 weekly, 12 monthly and 5 yearly")
+    parser.add_argument("--dry-run",                 dest="dryRun",                action="store_true",  default=False,                                      required=False, help="Don't back up or delete anything, just print which snapshots cleanup would keep and delete")
+    parser.add_argument("--rebuild-catalog",         dest="rebuildCatalog",        action="store_true",  default=False,                                      required=False, help="Regenerate the snapshot catalog (<s3-prefix>/catalog.json.gz) from a full listing of the prefix, then exit")
     parser.add_argument("--restore",                 dest="restore",               action="store_true",  default=False,                                      required=False, help="Perform a restore")
+    parser.add_argument("--restore-path",            dest="restorePaths",          action="append",      default=[],                                         required=False, help="With --restore, only restore this file or directory (somewhere inside one of the --directory options). Only the parts of the archive that hold it are downloaded. Can be specified more than once")
     parser.add_argument("--restore-stamp",           dest="restoreStamp",                                default=None,                                       required=False, help="The timestamp to restore - defaults to the lastest hourly backup")
+    parser.add_argument("--verify",                  dest="verify",                action="store_true",  default=False,                                      required=False, help="Hash every file of the --directory trees (restored or live) with --verify-workers processes and compare them with the integrity manifest of the snapshot a restore would use (--restore-stamp or the latest), reporting the throughput and every file that differs. With --restore, what was restored is verified before the post restore script runs")
+    parser.add_argument("--verify-workers",          dest="verifyWorkers",         type=int,             default=multiprocessing.cpu_count(),                required=False, help="How many processes hash the files with --verify [default: %default]")
+    parser.add_argument("--skip-integrity",          dest="skipIntegrity",         action="store_true",  default=False,                                      required=False, help="Don't write the integrity manifest (a sha256 of every file and of the archive, an md5 of every upload part) next to each archive - saves the cpu of hashing everything that is archived")
     parser.add_argument("--dump-dir",                dest="dumpDir",                                     default="/tmp/backup-dump",                         required=False, help="Where to store the tar.gz files before uploading to s3")
     parser.add_argument("--pre-restore-script",      dest="preRestoreScript",                            default=None,                                       required=False, help="A script to run blindly (./<script>) before restoring the latest backup")
     parser.add_argument("--post-restore-script",     dest="postRestoreScript",                           default=None,                                       required=False, help="A script to run blindly (./<script>) after restoring the latest backup")
+    parser.add_argument("--daemon",                  dest="daemon",                action="store_true",  default=False,                                      required=False, help="Stay resident, watch the --directory trees (with inotify when pyinotify is installed, by rescanning them otherwise) and back up the ones that changed once they have been quiet for --quiet-time seconds")
+    parser.add_argument("--quiet-time",              dest="quietTime",             type=int,             default=300,                                        required=False, help="With --daemon, how many seconds a directory has to go without changes before it is backed up [default: %default]")
+    parser.add_argument("--max-wait",                dest="maxWait",               type=int,             default=86400,                                      required=False, help="With --daemon, back up a directory that keeps changing once it has been waiting this many seconds, quiet or not (0 waits forever) [default: %default]")
+    parser.add_argument("--poll-interval",           dest="pollInterval",          type=int,             default=60,                                         required=False, help="With --daemon and without pyinotify, how many seconds apart the directories are rescanned for changes [default: %default]")
+    parser.add_argument("--status-socket",           dest="statusSocket",                                default=None,                                       required=False, help="With --daemon, a unix socket that answers every connection with the daemon's status as json (dirty directories, queue depth, last run...)")
+    parser.add_argument("--stream",                  dest="stream",                action="store_true",  default=False,                                      required=False, help="Stream each tar.gz straight to s3 while it is being compressed instead of staging it in --dump-dir. The post backup script then runs once the upload is done, unless --snapshot is used")
+    parser.add_argument("--incremental",             dest="incremental",           action="store_true",  default=False,                                      required=False, help="Only archive the files that changed since the previous snapshot (plus a list of deleted files), with a full baseline every --full-every snapshots")
+    parser.add_argument("--differential",            dest="differential",          action="store_true",  default=False,                                      required=False, help="With --incremental, archive everything that changed since the last full baseline instead of since the previous snapshot")
+    parser.add_argument("--full-every",              dest="fullEvery",             type=int,             default=24,                                         required=False, help="With --incremental, how many incremental snapshots to take before the next full baseline [default: %default]")
+    parser.add_argument("--hash-files",              dest="hashFiles",             action="store_true",  default=False,                                      required=False, help="With --incremental, also compare a sha1 of every file so changes that keep the size and mtime are caught")
+    parser.add_argument("--dedup",                   dest="dedup",                 action="store_true",  default=False,                                      required=False, help="Store snapshots as deduplicated content defined chunks under <s3-prefix>/chunks/ instead of tar.gz archives, uploading only chunks that aren't in s3 yet")
+    parser.add_argument("--chunk-size",              dest="chunkSize",             type=int,             default=1024,                                       required=False, help="With --dedup, the average chunk size in KB (chunks are between a quarter and four times this) [default: %default]")
+    parser.add_argument("--codec",                   dest="codec",                 choices=sorted(CODECS), default="gzip",                                   required=False, help="How to compress the archives: gzip, zstd (needs the zstandard module), lz4 (needs the lz4 module) or none. Restores read the codec from the snapshot [default: %default]")
+    parser.add_argument("--compress-level",          dest="compressLevel",         type=int,             default=None,                                       required=False, help="The compression level of --codec (gzip 0-9, zstd 1-22, lz4 0-16) - defaults to the codec's own default")
+    parser.add_argument("--adaptive-compression",    dest="adaptiveCompression",   action="store_true",  default=False,                                      required=False, help="Sample every large file and store the ones that don't compress (media, archives...) at the codec's fastest level instead of spending cpu on them")
+    parser.add_argument("--compress-workers",        dest="compressWorkers",       type=int,             default=multiprocessing.cpu_count(),                required=False, help="How many cores to compress with. Directories are compressed in parallel and each archive is gzipped in parallel blocks [default: %default]")
+    parser.add_argument("--upload-concurrency",      dest="uploadConcurrency",     type=int,             default=4,                                          required=False, help="How many parts of a multipart upload to send to s3 at the same time [default: %default]")
+    parser.add_argument("--upload-part-size",        dest="uploadPartSize",        type=int,             default=50,                                         required=False, help="The size in MB of each part of a multipart upload (minimum 5) [default: %default]")
+    parser.add_argument("--upload-retries",          dest="uploadRetries",         type=int,             default=5,                                          required=False, help="How many times to retry a failed upload part or download range before giving up [default: %default]")
+    parser.add_argument("--restore-concurrency",     dest="restoreConcurrency",    type=int,             default=4,                                          required=False, help="How many byte ranges of each archive to download at the same time during a restore [default: %default]")
+    parser.add_argument("--read-limit",              dest="readLimit",             type=float,           default=0,                                          required=False, help="How many MB/s to read from the disks, shared by every compress, scan and pool process (0 for no limit) [default: %default]")
+    parser.add_argument("--upload-limit",            dest="uploadLimit",           type=float,           default=0,                                          required=False, help="How many MB/s to send to s3, shared by every upload worker (0 for no limit) [default: %default]")
+    parser.add_argument("--nice",                    dest="nice",                  type=int,             default=0,                                          required=False, help="How much to lower the cpu priority of the backup (and every thread and process it starts) [default: %default]")
+    parser.add_argument("--ionice",                  dest="ionice",                type=ioniceClass,     default=None,                                       required=False, help="The io scheduling class of the backup: idle or best-effort:<0-7> (needs the ionice command)")
+    parser.add_argument("--memory-limit",            dest="memoryLimit",           type=int,             default=0,                                          required=False, help="Hold reads back while the backup and its pool processes use more than this many MB of memory (0 for no limit) [default: %default]")
+    parser.add_argument("--adaptive-throttle",       dest="adaptiveThrottle",      action="store_true",  default=False,                                      required=False, help="Halve the read and upload rates while the load per core is above --max-load or a disk takes longer than --max-disk-await, and raise them again once it isn't")
+    parser.add_argument("--max-load",                dest="maxLoad",               type=float,           default=1.0,                                        required=False, help="With --adaptive-throttle, the highest 1 minute load average per core before backing off [default: %default]")
+    parser.add_argument("--max-disk-await",          dest="maxDiskAwait",          type=float,           default=50,                                         required=False, help="With --adaptive-throttle, the most milliseconds a disk request may take on average before backing off [default: %default]")
+    parser.add_argument("--log-level",               dest="logLevel",              type=logLevel,        default="info",                                     required=False, help="The least important messages to log: debug (which adds a line per file), info, warning or error [default: %default]")
+    parser.add_argument("--report-file",             dest="reportFile",                                  default=None,                                       required=False, help="Write a json report of the run (duration, bytes, files and throughput of every phase) to this file")
+    parser.add_argument("--report-to-s3",            dest="reportToS3",            action="store_true",  default=False,                                      required=False, help="Also upload the json run report next to the snapshot (<s3-prefix>/<timestamp>/run-report.json)")
     parser.add_argument("--debug",                   dest="debug",                 action="store_true",  default=False,                                      required=False, help="Whether or not to run the app in debug mode [default: %default]")
     parser.add_argument("--version",                 dest="version",               action="store_true",  default=False,                                      required=False, help="Display the current version")
-    return parser.parse_args()
+    return parser.parse_args(args)
+
+def logLevel(name):
+    level = logging.getLevelName(name.upper())
+    if not isinstance(level, int):
+        raise argparse.ArgumentTypeError("unknown log level [%s]" % name)
+    return level
+
+def ioniceClass(value):
+    ## the arguments of the ionice command for --ionice
+    (name, level) = (value.split(":", 1) + [None])[:2]
+    if name == "idle" and level is None:
+        return ["-c", "3"]
+    if name == "best-effort" and (level is None or level in [str(i) for i in range(8)]):
+        return ["-c", "2"] + (["-n", level] if level is not None else [])
+    raise argparse.ArgumentTypeError("unknown io class [%s], use idle or best-effort:<0-7>" % value)
 
-def log(statement):
-    statement = str(statement)
-    if options.logFile is None:
+def log(statement, level=logging.INFO):
+    ## Lines are buffered and appended to the log file in whole lines, so threads and the
+    ## compression processes (which share the open file) never interleave partial lines.
+    if options.logFile is None or level < options.logLevel:
         return
-    if not os.path.exists(os.path.dirname(options.logFile)):
-        os.makedirs(os.path.dirname(options.logFile))
-    logFile = open(options.logFile, 'a')
     ts = datetime.datetime.now()
-    isFirst = True
-    for line in statement.split("\n"):
-        if isFirst:
-            if options.debug:
-                print("%s - %s" % (ts, line))
+    lines = str(statement).split("\n")
+    text = "%s - %s - %s\n" % (ts, logging.getLevelName(level), lines[0])
+    for line in lines[1:]:
+        text += "%s -    %s\n" % (ts, line)
+    if options.debug:
+        sys.stdout.write(text)
+        return
+    global LOG_BUFFERED
+    with LOG_LOCK:
+        LOG_BUFFER.append(text)
+        LOG_BUFFERED += len(text)
+        if LOG_BUFFERED >= LOG_BUFFER_SIZE or level >= logging.WARNING or time.time() - LOG_FLUSHED >= LOG_FLUSH_INTERVAL:
+            flushLogLocked()
+
+def flushLog():
+    ## called before anything else writes to the log file (scripts), before forking and at exit
+    with LOG_LOCK:
+        flushLogLocked()
+
+def reopenLog(signum=None, frame=None):
+    ## SIGHUP (from logrotate) makes the next flush open the log file again - the handler
+    ## can interrupt a thread that holds the log lock, so it only sets a flag
+    global LOG_REOPEN
+    LOG_REOPEN = True
+
+def flushLogLocked():
+    global LOG_FD, LOG_BUFFERED, LOG_FLUSHED, LOG_REOPEN
+    LOG_FLUSHED = time.time()
+    if not LOG_BUFFER:
+        return
+    if LOG_REOPEN and LOG_FD is not None:
+        os.close(LOG_FD)
+        LOG_FD = None
+    LOG_REOPEN = False
+    if LOG_FD is None:
+        if not os.path.exists(os.path.dirname(options.logFile)):
+            os.makedirs(os.path.dirname(options.logFile))
+        LOG_FD = os.open(options.logFile, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    data = "".join(LOG_BUFFER)
+    del LOG_BUFFER[:]
+    LOG_BUFFERED = 0
+    while data:
+        data = data[os.write(LOG_FD, data):]
+
+atexit.register(flushLog)
+
+class RunReport(object):
+    ## Totals per phase (pre-script, scan, compress, upload, cleanup, restore...) for the
+    ## json run report. The seconds of a phase are summed over everything recorded for it,
+    ## so work done in parallel can add up to more than the wall time of the run.
+    def __init__(self):
+        self.started = time.time()
+        self.timestamp = None
+        self.phases = {}
+        self.lock = threading.Lock()
+
+    def record(self, phase, seconds, size=0, files=0):
+        self.merge({phase: {"seconds": seconds, "bytes": size, "files": files, "count": 1}})
+
+    def merge(self, phases):
+        with self.lock:
+            for (phase, totals) in phases.iteritems():
+                current = self.phases.setdefault(phase, {"seconds": 0.0, "bytes": 0, "files": 0, "count": 0})
+                for (field, value) in totals.iteritems():
+                    current[field] += value
+
+    def toJson(self, status):
+        phases = {}
+        for (phase, totals) in self.phases.iteritems():
+            phases[phase] = dict(totals, mbPerSecond=totals["bytes"] / max(totals["seconds"], 0.001) / 1048576)
+        return json.dumps({
+            "version": 1,
+            "status": status,
+            "mode": "restore" if options.restore else "backup",
+            "host": socket.gethostname(),
+            "timestamp": self.timestamp,
+            "started": datetime.datetime.fromtimestamp(self.started).strftime("%Y-%m-%d-%H-%M-%S"),
+            "wallSeconds": time.time() - self.started,
+            "phases": phases,
+        }, indent=2, sort_keys=True)
+
+REPORT = RunReport()
+
+def writeReport(status):
+    if not options.reportFile and not options.reportToS3:
+        return
+    data = REPORT.toJson(status)
+    if options.reportFile:
+        with open(options.reportFile, 'w') as f:
+            f.write(data)
+        log("wrote the run report to [%s]" % options.reportFile)
+    ## only complete snapshots get a report - it is registered in the catalog so retention deletes it with them
+    if options.reportToS3 and REPORT.timestamp is not None and REPORT.timestamp in loadCatalog()["snapshots"]:
+        catalog = loadCatalog()
+        s3_key = "%s/%s/run-report.json" % (options.s3Prefix, REPORT.timestamp)
+        log("putting s3 key: %s" % s3_key)
+        getS3BackupBucket().new_key(s3_key).set_contents_from_string(data, encrypt_key=True)
+        catalog["snapshots"][REPORT.timestamp]["members"]["run-report.json"] = {"size": len(data), "etag": hashlib.md5(data).hexdigest()}
+        saveCatalog(catalog)
+
+class TokenBucket(object):
+    ## A rate limit in bytes per second, shared by every thread and every pool process of
+    ## a run - the state is in shared memory, so the bucket has to exist before a pool
+    ## forks. consume() takes its tokens right away and sleeps off the deficit outside the
+    ## lock, so concurrent workers line up behind each other instead of waking together.
+    def __init__(self, name, rate):
+        self.name = name
+        self.rate = rate
+        self.lock = multiprocessing.Lock()
+        ## the governor lowers the limit below the configured rate while the host is busy
+        self.limit = multiprocessing.Value("d", rate, lock=False)
+        self.tokens = multiprocessing.Value("d", 0.0, lock=False)
+        self.updated = multiprocessing.Value("d", time.time(), lock=False)
+        self.consumed = multiprocessing.Value("d", 0.0, lock=False)
+        self.throttled = multiprocessing.Value("d", 0.0, lock=False)
+        self.paused = multiprocessing.Value("b", 0, lock=False)
+
+    def consume(self, amount):
+        wait = 0.0
+        with self.lock:
+            now = time.time()
+            self.consumed.value += amount
+            limit = self.limit.value
+            if limit > 0:
+                ## at most a second's worth of tokens builds up while nothing is read
+                self.tokens.value = min(self.tokens.value + (now - self.updated.value) * limit, limit) - amount
+                if self.tokens.value < 0:
+                    wait = -self.tokens.value / limit
             else:
-                logFile.write("%s - %s\n" % (ts, line))
-            isFirst = False
+                self.tokens.value = 0.0
+            self.updated.value = now
+        if wait <= 0 and not self.paused.value:
+            return
+        started = time.time()
+        while self.paused.value:
+            time.sleep(0.1)
+        time.sleep(wait)
+        with self.lock:
+            self.throttled.value += time.time() - started
+
+    def take(self, field):
+        ## returns a counter and starts it over
+        with self.lock:
+            value = field.value
+            field.value = 0.0
+        return value
+
+class ThrottledReader(object):
+    ## a file object whose reads are charged to a token bucket
+    def __init__(self, fileobj, bucket):
+        self.fileobj = fileobj
+        self.bucket = bucket
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.bucket.consume(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+class ResourceGovernor(object):
+    ## The --read-limit and --upload-limit buckets of the run, and a thread that halves
+    ## their limits while the host is busy (--adaptive-throttle) and holds reads back while
+    ## the backup uses more than --memory-limit.
+    def __init__(self):
+        self.read = TokenBucket("reads", options.readLimit * 1048576)
+        self.upload = TokenBucket("uploads", options.uploadLimit * 1048576)
+        self.memoryLimit = options.memoryLimit * 1048576
+        self.overMemorySince = None
+        self.busy = False
+        self.diskStats = readDiskStats()
+        if options.adaptiveThrottle or self.memoryLimit:
+            monitor = threading.Thread(target=self.monitor, name="governor")
+            monitor.daemon = True
+            monitor.start()
+
+    def monitor(self):
+        while True:
+            time.sleep(GOVERNOR_INTERVAL)
+            try:
+                if options.adaptiveThrottle:
+                    self.adapt()
+                if self.memoryLimit:
+                    self.checkMemory()
+            except Exception:
+                log("the resource governor failed: %s" % traceback.format_exc(), logging.WARNING)
+
+    def adapt(self):
+        load = os.getloadavg()[0] / multiprocessing.cpu_count()
+        stats = readDiskStats()
+        diskWait = diskAwait(self.diskStats, stats)
+        self.diskStats = stats
+        busy = load > options.maxLoad or diskWait > options.maxDiskAwait
+        if busy != self.busy:
+            log("load %.2f per core, disk await %.1fms - %s" % (load, diskWait, "backing off" if busy else "speeding up again"))
+            self.busy = busy
+        for bucket in (self.read, self.upload):
+            observed = bucket.take(bucket.consumed) / GOVERNOR_INTERVAL
+            limit = bucket.limit.value
+            ## an idle bucket is left alone - its limit would be a guess
+            if busy and (limit or observed):
+                limit = max((limit or observed) / 2, GOVERNOR_MIN_RATE)
+            elif limit != bucket.rate:
+                limit *= 1.5
+                ## without a configured rate, the limit goes once it no longer holds anything back
+                if (bucket.rate and limit >= bucket.rate) or (not bucket.rate and limit >= 2 * observed):
+                    limit = bucket.rate
+            if limit != bucket.limit.value:
+                log("limiting %s to %s" % (bucket.name, "%.1f MB/s" % (limit / 1048576) if limit else "no limit"), logging.DEBUG)
+                bucket.limit.value = limit
+
+    def checkMemory(self):
+        rss = processTreeRss()
+        if rss <= self.memoryLimit:
+            if self.overMemorySince is not None:
+                log("memory use is down to %d bytes, reading again" % rss)
+                self.overMemorySince = None
+                self.read.paused.value = 0
+        elif self.overMemorySince is None:
+            log("using %d bytes of memory, more than --memory-limit - holding reads back" % rss)
+            self.overMemorySince = time.time()
+            self.read.paused.value = 1
+        elif self.read.paused.value and time.time() - self.overMemorySince > MEMORY_WAIT_LIMIT:
+            ## what isn't freed by then isn't going to be by waiting longer
+            log("still using %d bytes of memory after holding reads back for %ds, carrying on" % (rss, MEMORY_WAIT_LIMIT), logging.WARNING)
+            self.read.paused.value = 0
+
+def startGovernor():
+    ## runs before any thread or pool process is started, so they all inherit the priorities
+    global GOVERNOR
+    if options.nice:
+        log("cpu priority lowered to nice %d" % os.nice(options.nice))
+    if options.ionice:
+        if call(["ionice"] + options.ionice + ["-p", str(os.getpid())]) == 0:
+            log("io priority set to %s" % " ".join(options.ionice))
         else:
-            if options.debug:
-                print("%s -    %s" % (ts, line))
-            else:
-                logFile.write("%s -    %s\n" % (ts, line))
-    logFile.close()
+            log("Couldn't set the io priority with ionice", logging.WARNING)
+    GOVERNOR = ResourceGovernor()
+
+def throttleRead(size):
+    if GOVERNOR is not None:
+        GOVERNOR.read.consume(size)
+
+def throttleUpload(size):
+    if GOVERNOR is not None:
+        GOVERNOR.upload.consume(size)
+
+def recordThrottling():
+    ## the seconds are summed over every worker that was held back, like the other phases
+    if GOVERNOR is None:
+        return
+    for bucket in (GOVERNOR.read, GOVERNOR.upload):
+        seconds = bucket.take(bucket.throttled)
+        if seconds:
+            log("throttled %s for %.2fs" % (bucket.name, seconds))
+            REPORT.record("throttled-%s" % bucket.name, seconds)
+
+def readDiskStats():
+    ## {device: (requests, milliseconds spent on them)} from /proc/diskstats
+    stats = {}
+    try:
+        with open("/proc/diskstats") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 11 or fields[2].startswith(("loop", "ram")):
+                    continue
+                stats[fields[2]] = (int(fields[3]) + int(fields[7]), int(fields[6]) + int(fields[10]))
+    except IOError:
+        pass
+    return stats
+
+def diskAwait(before, after):
+    ## the longest any disk took per request on average in between two readDiskStats()
+    worst = 0.0
+    for (device, (requests, milliseconds)) in after.iteritems():
+        if device in before and requests > before[device][0]:
+            worst = max(worst, float(milliseconds - before[device][1]) / (requests - before[device][0]))
+    return worst
+
+def processTreeRss():
+    ## the resident memory of this process and its children (the pool processes)
+    total = 0
+    me = os.getpid()
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % pid) as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except IOError:
+            continue
+        if int(pid) == me or int(fields[1]) == me:
+            total += int(fields[21]) * os.sysconf("SC_PAGE_SIZE")
+    return total
 
 def getAvailabilityZone():
     ## cached
@@ -127,7 +572,7 @@ def metaData(dataPath):
     ## like to modify their dhcp tables...
     return requests.get('http://169.254.169.254/latest/meta-data/%s' % dataPath).text
 
-def runScript(script, onFailure = ""):
+def runScript(script, onFailure = "", phase = None, args = []):
     if os.path.isfile(script) != True:
         error("Script [%s] was not found" % script)
     log("running script [%s]" % script)
@@ -136,8 +581,14 @@ def runScript(script, onFailure = ""):
     proc_ret_code = None
     run = []
     run.append(script)
+    run.extend(args)
+    ## the script appends to the log file itself, so everything logged so far goes first
+    flushLog()
+    started = time.time()
     with open(options.logFile, 'a') as log_file:
         proc_ret_code = subprocess.call(run, shell=False, stdout=log_file, stderr=log_file)
+    if phase is not None:
+        REPORT.record(phase, time.time() - started)
 
     if proc_ret_code == 0:
         ## return the return code
@@ -148,20 +599,39 @@ def runScript(script, onFailure = ""):
     return proc_ret_code
     
 def error(message):
-    log("ERROR: %s" % message)
+    log(message, logging.ERROR)
     raise Exception(message)
 
 def restoreDirectories():
+    backupKey = selectBackupKey()
+    ## if our key is still none at this point, we have never performed a backup - just return
+    if backupKey == None:
+        return
+
+    bucket = getS3BackupBucket()
+    log("restore got bucket: %s" % bucket)
+    started = time.time()
+    ## every directory is restored at the same time
+    pool = ThreadPool(max(len(options.backupDirectories), 1))
+    try:
+        size = sum(pool.map(lambda directory: restoreDirectory(backupKey, directory), options.backupDirectories))
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = max(time.time() - started, 0.001)
+    log("restored %d directories (%d bytes) in %.2fs (%.2f MB/s)" % (len(options.backupDirectories), size, elapsed, size / elapsed / 1048576))
+    REPORT.record("restore", elapsed, size, len(options.backupDirectories))
+
+def selectBackupKey():
+    ## the snapshot restores and --verify use - None when there has never been a backup
     backupFiles = getBackupFiles()
     log("backup files: %s" % backupFiles)
     backupKey = None
     ## try to restore the timestamp they asked for
     if options.restoreStamp:
-        for key, stampType in backupFiles.iteritems():
-            for backupDir in stampType:
-                log("  backupDir: %s" % backupDir)
-                if(backupDir.split('/')[:-1] == options.restoreStamp):
-                    backupKey = backupDir
+        stamp = options.restoreStamp.rstrip("/").split("/")[-1]
+        if stamp in loadCatalog()["snapshots"]:
+            backupKey = "%s/%s" % (options.s3Prefix, stamp)
         if backupKey == None:
             log("restoreStamp was not found - restoring the latest")
     
@@ -175,60 +645,1395 @@ def restoreDirectories():
             backupKey = backupFiles['weekly'][0]
         elif backupFiles['monthly'] and backupFiles['monthly'][0]:
             backupKey = backupFiles['monthly'][0]
+    return backupKey
 
-    ## if our key is still none at this point, we have never performed a backup - just return
+def restoreDirectory(backupKey, directory):
+    log("working on directory: %s" % directory)
+    name = archiveName(directory)
+    restorePath = os.path.abspath(os.path.join(directory, os.pardir))
+    wanted = None
+    if options.restorePaths:
+        wanted = getRestoreArcnames(directory)
+        if not wanted:
+            log("  nothing to restore in [%s]" % directory)
+            return 0
+        log("  only restoring: %s" % wanted)
+    ## incremental snapshots are rebuilt by replaying every snapshot they build on, oldest first
+    ## (a directory carried over unchanged is restored from the snapshot it was taken in)
+    snapshot = loadCatalog()["snapshots"][backupKey.split("/")[-1]]["directories"].get(name)
+    steps = [backupKey]
+    if snapshot is not None:
+        steps = ["%s/%s" % (options.s3Prefix, timestamp) for timestamp in snapshot["chain"] + [snapshot["timestamp"]]]
+        log("  %s snapshot, replaying: %s" % (snapshot["type"], steps))
+    size = 0
+    for step in steps:
+        if snapshot is not None and snapshot["type"] == "dedup":
+            size += restoreDedupSnapshot(step, name, restorePath, wanted)
+            continue
+        codec = getSnapshotCodec(step, name)
+        if wanted is None:
+            size += extractArchive(step, name, codec, restorePath)
+        else:
+            size += extractArchiveMembers(step, name, codec, restorePath, wanted)
+        manifest = readJsonFromS3("%s/%s.manifest.json.gz" % (step, name))
+        if manifest is not None:
+            removeDeletedFiles(restorePath, [arcname for arcname in manifest["deleted"] if isWanted(arcname, wanted)])
+    return size
+
+def verifyDirectories():
+    ## Hashes the files of every --directory (restored or live) in a pool of processes and
+    ## compares them with the integrity manifest of the snapshot a restore would use
+    backupKey = selectBackupKey()
     if backupKey == None:
-        return
+        error("there is no snapshot to verify against")
+    started = time.time()
+    ## anything still buffered would be written again by every forked process
+    flushLog()
+    pool = multiprocessing.Pool(max(options.verifyWorkers, 1))
+    try:
+        results = [verifyDirectory(backupKey, directory, pool) for directory in options.backupDirectories]
+    finally:
+        pool.close()
+        pool.join()
+    size = sum(result[0] for result in results)
+    files = sum(result[1] for result in results)
+    problems = sum(result[2] for result in results)
+    elapsed = max(time.time() - started, 0.001)
+    log("verified %d files (%d bytes) of %d directories against %s in %.2fs (%.2f MB/s with %d processes)" % (files, size, len(options.backupDirectories), backupKey, elapsed, size / elapsed / 1048576, options.verifyWorkers))
+    REPORT.record("verify", elapsed, size, files)
+    if problems:
+        error("%d files don't match %s" % (problems, backupKey))
 
-    if options.dumpDir == None or os.path.exists(options.dumpDir) == False:
-        error("invalid dump dir [%s]" % options.dumpDir)
-    bucket = getS3BackupBucket()
-    log("restore got bucket: %s" % bucket)
-    for directory in options.backupDirectories:
-        log("working on directory: %s" % directory)
-        filename = "%s/%s.tar.gz" % (options.dumpDir, directory.replace(os.path.sep, "_"))
-        s3Key = "%s/%s" % (backupKey, filename.split('/')[-1])
-        log("  s3Key: %s" % s3Key)
-        log("  filename: %s" % filename)
-        log("  downloadFromS3(%s, %s)" % (s3Key, filename))
-        downloadFromS3(s3Key, filename)
-        tar = tarfile.open(filename)
-        tar.extractall(path = os.path.abspath(os.path.join(directory, os.pardir)))
-        tar.close()
-
-def runBackup():
-    backupfiles = []
-    if options.dumpDir == None or os.path.exists(options.dumpDir) == False:
+def verifyDirectory(backupKey, directory, pool):
+    ## returns (bytes hashed, files hashed, problems found)
+    name = archiveName(directory)
+    ## a directory carried over unchanged is checked against the snapshot it was taken in
+    snapshot = loadCatalog()["snapshots"][backupKey.split("/")[-1]]["directories"].get(name)
+    timestamp = snapshot["timestamp"] if snapshot is not None else backupKey.split("/")[-1]
+    integrity = readJsonFromS3("%s/%s/%s.integrity.json.gz" % (options.s3Prefix, timestamp, name))
+    if integrity is None:
+        log("[%s] has no integrity manifest in %s, nothing to verify it against" % (directory, timestamp), logging.WARNING)
+        return (0, 0, 0)
+    problems = verifyArchive(timestamp, integrity["archive"])
+    ## after restoring some paths only those are there to verify
+    wanted = getRestoreArcnames(directory) if options.restorePaths else None
+    expected = dict((arcname, digest) for (arcname, digest) in integrity["files"].iteritems() if isWanted(arcname, wanted))
+    jobs = []
+    present = set()
+    unknown = 0
+    unchecked = 0
+    for (path, arcname, st) in scanDirectory(directory):
+        if not stat.S_ISREG(st.st_mode) or not isWanted(arcname, wanted):
+            continue
+        present.add(arcname)
+        if arcname not in expected:
+            ## new since the snapshot, or from before there were integrity manifests
+            log("  not in the integrity manifest: %s" % arcname, logging.DEBUG)
+            unknown += 1
+        elif expected[arcname] is None:
+            unchecked += 1
+        else:
+            jobs.append((path, arcname))
+    started = time.time()
+    size = 0
+    differ = 0
+    unreadable = 0
+    for (arcname, digest, fileSize) in pool.imap_unordered(hashFileJob, jobs, VERIFY_BATCH):
+        size += fileSize
+        if digest is None:
+            log("  couldn't read: %s" % arcname, logging.WARNING)
+            unreadable += 1
+        elif digest != expected[arcname]:
+            log("  differs from the snapshot: %s" % arcname, logging.WARNING)
+            differ += 1
+    missing = sorted(set(expected) - present)
+    for arcname in missing:
+        log("  missing: %s" % arcname, logging.WARNING)
+    elapsed = max(time.time() - started, 0.001)
+    log("verified [%s] against %s: %d files (%d bytes) in %.2fs (%.2f MB/s) - %d differ, %d missing, %d unreadable, %d not in the manifest, %d without a checksum" % (directory, timestamp, len(jobs), size, elapsed, size / elapsed / 1048576, differ, len(missing), unreadable, unknown, unchecked))
+    return (size, len(jobs), problems + differ + len(missing) + unreadable)
+
+def verifyArchive(timestamp, archive):
+    ## the archive in s3 has to have the size and etag worked out while it was written
+    if archive is None or archive["etag"] is None:
+        return 0
+    member = loadCatalog()["snapshots"].get(timestamp, {}).get("members", {}).get(archive["name"])
+    if member is None:
+        log("  the archive %s/%s is missing from s3" % (timestamp, archive["name"]), logging.WARNING)
+        return 1
+    if member["size"] != archive["size"] or member["etag"] != archive["etag"]:
+        log("  the archive %s/%s in s3 (%d bytes, etag %s) isn't the one that was written (%d bytes, etag %s)" % (timestamp, archive["name"], member["size"], member["etag"], archive["size"], archive["etag"]), logging.WARNING)
+        return 1
+    return 0
+
+def hashFileJob(job):
+    ## runs in a --verify process
+    (path, arcname) = job
+    try:
+        return (arcname, hashFile(path, "sha256"), os.lstat(path).st_size)
+    except (IOError, OSError):
+        return (arcname, None, 0)
+
+def getRestoreArcnames(directory):
+    ## turn the --restore-path options that fall inside the directory into archive names
+    directory = os.path.abspath(directory)
+    arcnames = []
+    for path in options.restorePaths:
+        path = os.path.abspath(path)
+        if path == directory or path.startswith(directory + os.path.sep):
+            arcnames.append(os.path.normpath(os.path.join(os.path.basename(directory), os.path.relpath(path, directory))))
+    return arcnames
+
+def isWanted(arcname, wanted):
+    if wanted is None:
+        return True
+    for path in wanted:
+        if arcname == path or arcname.startswith(path + "/"):
+            return True
+    return False
+
+def getSnapshotCodec(step, name):
+    ## archives from before the codec was recorded in the snapshot are gzip
+    snapshot = loadCatalog()["snapshots"].get(step.split("/")[-1], {}).get("directories", {}).get(name)
+    return getCodec((snapshot or {}).get("codec", "gzip"))
+
+def openArchiveStream(reader, codec, offsets=None, start=0, end=None):
+    ## gzip can be read as one stream - the other codecs are decompressed a frame at a
+    ## time, with the frame sizes taken from the offset index
+    if codec.name == "gzip":
+        return GzipStreamReader(reader)
+    if offsets is None:
+        error("%s archives can't be read without their offset index" % codec.name)
+    if end is None:
+        end = offsets["compressedSize"]
+    starts = [compressedOffset for (offset, compressedOffset) in offsets["blocks"]] + [offsets["compressedSize"]]
+    return FrameStreamReader(reader, codec, [b - a for (a, b) in zip(starts, starts[1:]) if a >= start and b <= end])
+
+def extractArchiveMembers(step, name, codec, restorePath, wanted):
+    ## fetch just the compressed blocks that hold the wanted members and extract only those
+    started = time.time()
+    s3Key = "%s/%s%s" % (step, name, codec.extension)
+    log("  s3Key: %s" % s3Key)
+    offsets = readJsonFromS3("%s/%s.offsets.json.gz" % (step, name))
+    if offsets is None:
+        log("  no offset index for [%s], reading the whole archive" % s3Key)
+        reader = S3RangeReader(s3Key)
+        gz = openArchiveStream(reader, codec)
+        try:
+            with closing(tarfile.open(fileobj=gz, mode="r|")) as tar:
+                tar.extractall(path = restorePath, members = restorableMembers(tar, restorePath, wanted))
+        finally:
+            reader.close()
+        return gz.position
+
+    ## A hard link can only be made when its target is restored too. When it isn't, the
+    ## target's member is extracted under the link's name instead (indexes from before
+    ## links were recorded can't do that, those links are skipped).
+    plan = {}
+    targets = dict((arcname, (offset, length)) for (arcname, offset, length) in offsets["members"])
+    for (arcname, offset, length) in offsets["members"]:
+        if not isWanted(arcname, wanted):
+            continue
+        target = offsets.get("links", {}).get(arcname)
+        if target is not None and not isWanted(target, wanted) and target in targets:
+            (offset, length) = targets[target]
+            plan.setdefault((offset, length), []).append(arcname)
+        else:
+            plan.setdefault((offset, length), []).append(None)
+
+    ## work out which compressed byte ranges hold the members, merging neighbouring ones
+    blockStarts = [offset for (offset, compressedOffset) in offsets["blocks"]]
+    spans = []
+    for (offset, length) in sorted(plan):
+        names = plan[(offset, length)]
+        first = bisect.bisect_right(blockStarts, offset) - 1
+        last = bisect.bisect_right(blockStarts, offset + length - 1) - 1
+        start = offsets["blocks"][first][1]
+        end = offsets["compressedSize"]
+        if last + 1 < len(offsets["blocks"]):
+            end = offsets["blocks"][last + 1][1]
+        if spans and start <= spans[-1][1]:
+            spans[-1][1] = max(spans[-1][1], end)
+            spans[-1][3].append((offset, length, names))
+        else:
+            spans.append([start, end, blockStarts[first], [(offset, length, names)]])
+
+    downloaded = 0
+    size = 0
+    for (start, end, position, members) in spans:
+        reader = S3RangeReader(s3Key, start, end)
+        gz = openArchiveStream(reader, codec, offsets, start, end)
+        try:
+            for (offset, length, names) in members:
+                ## skip ahead to the member - nothing before it in the span is needed
+                while position < offset:
+                    position += len(gz.read(min(offset - position, COMPRESS_BLOCK_SIZE)))
+                member = LimitedReader(gz, length)
+                extractIndexedMember(member, restorePath, names)
+                while member.read(COMPRESS_BLOCK_SIZE):
+                    pass
+                position += length
+                size += length
+        finally:
+            reader.close()
+        downloaded += end - start
+    elapsed = max(time.time() - started, 0.001)
+    log("  extracted %d members of [%s]: downloaded %d of %d bytes in %d ranges in %.2fs (%.2f MB/s)" % (sum(len(span[3]) for span in spans), s3Key, downloaded, offsets["compressedSize"], len(spans), elapsed, downloaded / elapsed / 1048576))
+    return size
+
+def extractIndexedMember(fileobj, restorePath, names):
+    ## Extracts the one member at the start of fileobj under every name in <names> (None
+    ## keeps its own name) - the first copy is extracted, the others are hard linked to it.
+    with closing(tarfile.open(fileobj=fileobj, mode="r|")) as tar:
+        for tarinfo in restorableMembers(tar, restorePath):
+            first = None
+            for name in names:
+                path = os.path.join(restorePath, name or tarinfo.name)
+                if first is None:
+                    tarinfo.name = name or tarinfo.name
+                    tar.extract(tarinfo, path = restorePath)
+                    first = path
+                    continue
+                if os.path.lexists(path):
+                    os.remove(path)
+                elif not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                os.link(first, path)
+
+def restorableMembers(tar, restorePath, wanted=None):
+    ## tarfile can't look back in a stream for the target of a hard link that wasn't
+    ## extracted - those links are skipped instead of failing the restore
+    for tarinfo in tar:
+        if not isWanted(tarinfo.name, wanted):
+            continue
+        if tarinfo.islnk() and not os.path.exists(os.path.join(restorePath, tarinfo.linkname)):
+            log("  skipping hard link [%s], its target [%s] wasn't restored" % (tarinfo.name, tarinfo.linkname), logging.WARNING)
+            continue
+        yield tarinfo
+
+class LimitedReader(object):
+    ## a file object that reads at most <size> bytes from another one
+    def __init__(self, fileobj, size):
+        self.fileobj = fileobj
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fileobj.read(size)
+        self.remaining -= len(data)
+        return data
+
+def extractArchive(step, name, codec, restorePath):
+    ## download the archive in parallel ranges and untar it while the bytes arrive
+    started = time.time()
+    s3_key = "%s/%s%s" % (step, name, codec.extension)
+    log("  s3Key: %s" % s3_key)
+    offsets = None
+    if codec.name != "gzip":
+        offsets = readJsonFromS3("%s/%s.offsets.json.gz" % (step, name))
+    reader = S3RangeReader(s3_key)
+    gz = openArchiveStream(reader, codec, offsets)
+    try:
+        with closing(tarfile.open(fileobj=gz, mode="r|")) as tar:
+            tar.extractall(path = restorePath, members = restorableMembers(tar, restorePath))
+    finally:
+        reader.close()
+    elapsed = max(time.time() - started, 0.001)
+    log("  extracted [%s]: downloaded %d bytes, extracted %d bytes in %.2fs (%.2f MB/s)" % (s3_key, reader.position, gz.position, elapsed, reader.position / elapsed / 1048576))
+    return gz.position
+
+class BlockReader(object):
+    ## A read-only file object over a source that produces data a block at a time.
+    ## Subclasses implement nextBlock(), which returns "" once the data runs out.
+    def __init__(self):
+        self.block = ""
+        self.offset = 0
+        self.position = 0
+        self.eof = False
+
+    def read(self, size=-1):
+        chunks = []
+        total = 0
+        while size < 0 or total < size:
+            if self.offset >= len(self.block):
+                if self.eof:
+                    break
+                self.block = self.nextBlock()
+                self.offset = 0
+                if not self.block:
+                    self.eof = True
+                continue
+            available = len(self.block) - self.offset
+            if size >= 0:
+                available = min(available, size - total)
+            chunks.append(self.block[self.offset:self.offset + available])
+            self.offset += available
+            total += available
+        self.position += total
+        return "".join(chunks)
+
+    def tell(self):
+        return self.position
+
+class S3RangeReader(BlockReader):
+    ## Reads an s3 key (or the bytes between start and end of it) through ranged GETs
+    ## that the download pool fetches a few ranges ahead of the reader and hands back in order.
+    def __init__(self, s3_key, start=0, end=None, concurrency=None):
+        BlockReader.__init__(self)
+        if end is None:
+            key = getS3BackupBucket().get_key(s3_key)
+            if key is None:
+                error("[%s] was not found in s3" % s3_key)
+            end = key.size
+        self.s3Key = s3_key
+        self.size = end - start
+        concurrency = max(concurrency or options.restoreConcurrency, 1)
+        ranges = [(s3_key, offset, min(offset + RESTORE_RANGE_SIZE, end)) for offset in xrange(start, end, RESTORE_RANGE_SIZE)]
+        self.ranges = orderedParallelMap(getDownloadPool(), fetchRange, ranges, concurrency + 1)
+
+    def nextBlock(self):
+        return next(self.ranges, "")
+
+    def close(self):
+        ## the pool is shared, so just stop asking it for more ranges
+        self.ranges = iter([])
+
+def fetchRange(job):
+    (s3_key, start, end) = job
+    attempt = 0
+    while True:
+        try:
+            data = getThreadBucket().new_key(s3_key).get_contents_as_string(headers={"Range": "bytes=%d-%d" % (start, end - 1)})
+            if len(data) != end - start:
+                raise IOError("expected %d bytes but got %d" % (end - start, len(data)))
+            return data
+        except Exception as e:
+            attempt += 1
+            if attempt > options.uploadRetries:
+                raise
+            delay = min(2 ** attempt, 60)
+            log("range %d-%d of [%s] failed (attempt %d of %d), retrying in %ds: %s" % (start, end, s3_key, attempt, options.uploadRetries, delay, e), logging.WARNING)
+            time.sleep(delay)
+
+class GzipStreamReader(BlockReader):
+    ## Gunzips another file object on the fly, including streams made of several gzip
+    ## members. At most a block is decompressed at a time, however well the data compresses.
+    def __init__(self, fileobj):
+        BlockReader.__init__(self)
+        self.fileobj = fileobj
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.pending = ""
+
+    def nextBlock(self):
+        while True:
+            if not self.pending:
+                self.pending = self.fileobj.read(COMPRESS_BLOCK_SIZE)
+                if not self.pending:
+                    return self.decompressor.flush()
+            data = self.decompressor.decompress(self.pending, COMPRESS_BLOCK_SIZE)
+            self.pending = self.decompressor.unconsumed_tail
+            if self.decompressor.unused_data:
+                ## the next gzip member starts here
+                self.pending = self.decompressor.unused_data
+                self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            if data:
+                return data
+
+class FrameStreamReader(BlockReader):
+    ## Decompresses another file object one frame at a time, given the compressed size of
+    ## every frame. A frame never holds more than a block, so neither does memory.
+    def __init__(self, fileobj, codec, frameSizes):
+        BlockReader.__init__(self)
+        self.fileobj = fileobj
+        self.codec = codec
+        self.frameSizes = iter(frameSizes)
+
+    def nextBlock(self):
+        for size in self.frameSizes:
+            frame = self.fileobj.read(size)
+            if len(frame) != size:
+                error("archive ended in the middle of a %s frame" % self.codec.name)
+            data = self.codec.decompress(frame)
+            if data:
+                return data
+        return ""
+
+def restoreDedupSnapshot(step, name, restorePath, wanted=None):
+    started = time.time()
+    index = readJsonFromS3("%s/%s.index.json.gz" % (step, name))
+    entries = [entry for entry in index["entries"] if isWanted(entry["name"], wanted)]
+    pool = ThreadPool(options.uploadConcurrency)
+    try:
+        ## the chunks of every file are fetched in parallel but handed back in order
+        chunks = orderedParallelMap(pool, fetchChunk, (digest for entry in entries if entry["type"] == "file" for digest in entry["chunks"]), 2 * options.uploadConcurrency)
+        size = 0
+        for entry in entries:
+            path = os.path.join(restorePath, entry["name"])
+            ## a single restored file may not have its parent directories restored with it
+            if entry["type"] != "dir" and not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            if entry["type"] == "dir":
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+            elif entry["type"] == "symlink":
+                if os.path.lexists(path):
+                    os.remove(path)
+                os.symlink(entry["target"], path)
+            else:
+                with open(path, 'wb') as f:
+                    for digest in entry["chunks"]:
+                        f.write(next(chunks))
+                size += entry["size"]
+            setEntryAttributes(path, entry)
+    finally:
+        pool.terminate()
+    ## writing the files changed the directory mtimes, so put them back deepest first
+    for entry in reversed(entries):
+        if entry["type"] == "dir":
+            setEntryAttributes(os.path.join(restorePath, entry["name"]), entry)
+    elapsed = max(time.time() - started, 0.001)
+    log("  restored %d entries (%d bytes) from chunks in %.2fs (%.2f MB/s)" % (len(entries), size, elapsed, size / elapsed / 1048576))
+    return size
+
+def setEntryAttributes(path, entry):
+    if os.geteuid() == 0:
+        os.lchown(path, entry["uid"], entry["gid"])
+    if entry["type"] != "symlink":
+        os.chmod(path, entry["mode"])
+        os.utime(path, (entry["mtime"], entry["mtime"]))
+
+def orderedParallelMap(pool, func, iterable, window):
+    ## like pool.imap, but with at most <window> calls queued up at a time
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def removeDeletedFiles(restorePath, deleted):
+    for arcname in deleted:
+        path = os.path.join(restorePath, arcname)
+        log("  removing deleted file: %s" % path, logging.DEBUG)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.remove(path)
+
+def archiveName(directory):
+    return directory.replace(os.path.sep, "_")
+
+def runBackup(timestamp, directories):
+    if not options.stream and (options.dumpDir == None or os.path.exists(options.dumpDir) == False):
         error("invalid dump dir [%s]" % options.dumpDir)
-    for directory in options.backupDirectories:
+    if options.dedup:
+        return dedupBackup(timestamp, directories)
+    codec = getCodec(options.codec)
+    jobs = []
+    snapshots = []
+    for directory in directories:
         log("working on directory: %s" % directory)
-        filename = "%s/%s.tar.gz" % (options.dumpDir, directory.replace(os.path.sep, "_"))
-        log("creating file: %s" % filename)
         if os.path.exists(directory) == False:
             error("invalid directory specified")
-        with closing(tarfile.open(filename, "w:gz")) as tar:
-            tar.add(directory, arcname=os.path.basename(directory), exclude=exclude_function)
-        backupfiles.append(filename)
-    log("created archive [%s]" % filename)
-    return backupfiles
-
-def exclude_function(tarinfo):
-    for regex in options.excludes:
-        matcher = re.compile(regex)
-        if matcher.match(tarinfo):
-            log("skipping file: %s" % tarinfo)
-            return True
-    log("adding file: %s" % tarinfo)
-    return False
+        filename = "%s/%s%s" % (options.dumpDir, archiveName(directory), codec.extension)
+        (members, snapshot, manifest) = planSnapshot(directory, timestamp)
+        snapshot["codec"] = codec.name
+        snapshots.append((directory, snapshot, manifest))
+        if options.stream:
+            jobs.append((directory, "%s/%s/%s" % (options.s3Prefix, timestamp, os.path.basename(filename)), members))
+        else:
+            jobs.append((directory, filename, members))
+
+    ## split the cores between the directories first and the blocks of each archive second
+    parallel = max(min(options.compressWorkers, len(jobs)), 1)
+    threads = max(options.compressWorkers // parallel, 1)
+    log("compressing %d directories, %d at a time with %d threads each" % (len(jobs), parallel, threads))
+    if options.stream:
+        ## every stream buffers one part, and the upload pool holds two per worker for all of them
+        partMemory = getPartSize(0) * (parallel + 2 * max(options.uploadConcurrency, 1))
+        log("streaming to s3 with at most %d bytes of parts in memory" % partMemory)
+        if options.memoryLimit and partMemory > options.memoryLimit * 1048576:
+            log("the parts alone can take more than --memory-limit, lower --upload-part-size or --upload-concurrency", logging.WARNING)
+    jobs = [(directory, target, threads, members) for (directory, target, members) in jobs]
+    if parallel == 1:
+        results = map(archiveDirectoryJob, jobs)
+    else:
+        ## the compression threads release the gil, so when every archive feeds an upload
+        ## from this process threads are enough - otherwise use separate processes
+        if options.stream:
+            pool = ThreadPool(parallel)
+        else:
+            ## anything still buffered would be written again by every forked process
+            flushLog()
+            pool = multiprocessing.Pool(parallel)
+        try:
+            results = pool.map(archiveDirectoryJob, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    targets = [target for (target, offsets, integrity, phases) in results]
+    for (target, offsets, integrity, phases) in results:
+        if phases is not None:
+            REPORT.merge(phases)
+        if integrity is not None and not options.stream:
+            ARCHIVE_DIGESTS[target] = integrity["archive"]
+
+    ## the snapshot metadata goes up after the archives - its presence marks a complete snapshot
+    for ((directory, snapshot, manifest), (target, offsets, integrity, phases)) in zip(snapshots, results):
+        name = archiveName(directory)
+        targets.append(saveBackupObject(timestamp, "%s.offsets.json.gz" % name, gzipJson(offsets)))
+        if manifest is not None:
+            targets.append(saveBackupObject(timestamp, "%s.manifest.json.gz" % name, gzipJson(manifest)))
+        if integrity is not None:
+            integrity["timestamp"] = timestamp
+            completeIntegrity(integrity, snapshot, manifest)
+            targets.append(saveBackupObject(timestamp, "%s.integrity.json.gz" % name, gzipJson(integrity)))
+        targets.append(saveBackupObject(timestamp, "%s.snapshot.json" % name, json.dumps(snapshot)))
+    if options.stream:
+        return []
+    return targets
+
+def planSnapshot(directory, timestamp):
+    ## Works out what a snapshot of the directory has to contain. Returns the members to
+    ## archive (None for everything), the snapshot metadata and, in incremental mode,
+    ## the manifest with the state of every file and what was deleted since the base.
+    name = archiveName(directory)
+    snapshot = newSnapshot(directory, timestamp, "full")
+    if not options.incremental:
+        return (None, snapshot, None)
+
+    (dirs, files, members) = scanDirectoryState(directory)
+    manifest = {"version": 1, "timestamp": timestamp, "directory": directory,
+                "dirs": [arcname for (path, arcname) in dirs],
+                "files": dict((arcname, state) for (arcname, (path, state)) in files.iteritems()),
+                "deleted": []}
+    previous = getLatestSnapshot(name)
+    if previous is None or previous["incrementals"] >= options.fullEvery:
+        log("taking a full baseline of [%s]" % directory)
+        return (members, snapshot, manifest)
+    ## differential snapshots always compare against the baseline, incremental ones against the previous snapshot
+    if options.differential:
+        base = (previous["chain"] or [previous["timestamp"]])[0]
+        chain = [base]
+    else:
+        base = previous["timestamp"]
+        chain = previous["chain"] + [base]
+    baseManifest = readJsonFromS3("%s/%s/%s.manifest.json.gz" % (options.s3Prefix, base, name))
+    if baseManifest is None:
+        log("no manifest for [%s] in %s, taking a full baseline" % (directory, base))
+        return (members, snapshot, manifest)
+
+    baseFiles = baseManifest["files"]
+    changed = []
+    for arcname, (path, state) in sorted(files.iteritems()):
+        baseState = baseFiles.get(arcname)
+        if baseState is None or baseState[:3] != state[:3] or (state[3] is not None and baseState[3] != state[3]):
+            changed.append((path, arcname))
+    current = set(files)
+    current.update(manifest["dirs"])
+    manifest["deleted"] = sorted((set(baseFiles) | set(baseManifest["dirs"])) - current)
+    snapshot["type"] = "differential" if options.differential else "incremental"
+    snapshot["chain"] = chain
+    snapshot["incrementals"] = previous["incrementals"] + 1
+    log("%s snapshot of [%s] against %s: %d changed, %d deleted" % (snapshot["type"], directory, base, len(changed), len(manifest["deleted"])))
+    ## every directory is archived (without its contents) so new and empty ones come back too
+    return (dirs + changed, snapshot, manifest)
+
+def completeIntegrity(integrity, snapshot, manifest):
+    ## an incremental snapshot only archives what changed - the checksums of the other
+    ## files come from the integrity manifest of its base, so every one covers the whole tree
+    if manifest is None or not snapshot["chain"]:
+        return
+    base = readJsonFromS3("%s/%s/%s.integrity.json.gz" % (options.s3Prefix, snapshot["chain"][-1], archiveName(integrity["directory"])))
+    if base is None:
+        log("no integrity manifest in %s, only the files archived now can be verified" % snapshot["chain"][-1], logging.WARNING)
+        integrity["complete"] = False
+        return
+    files = integrity["files"]
+    for arcname in manifest["files"]:
+        if arcname not in files and arcname in base["files"]:
+            files[arcname] = base["files"][arcname]
+    integrity["complete"] = base["complete"]
+
+def carryOverSnapshots(timestamp, directories):
+    ## The directories that weren't backed up (because they didn't change) get a copy of
+    ## their latest snapshot metadata, so every snapshot can still restore every directory.
+    ## The copy keeps its timestamp - restores and retention follow it to the actual archive.
+    targets = []
+    for directory in options.backupDirectories:
+        if directory in directories:
+            continue
+        name = archiveName(directory)
+        previous = getLatestSnapshot(name)
+        if previous is None:
+            log("[%s] has never been backed up, nothing to carry over" % directory, logging.WARNING)
+            continue
+        log("[%s] is unchanged since %s" % (directory, previous["timestamp"]))
+        targets.append(saveBackupObject(timestamp, "%s.snapshot.json" % name, json.dumps(previous)))
+    if options.stream:
+        return []
+    return targets
+
+def newSnapshot(directory, timestamp, snapshotType):
+    return {"version": 1, "timestamp": timestamp, "directory": directory, "type": snapshotType, "chain": [], "incrementals": 0}
+
+def dedupBackup(timestamp, directories):
+    targets = []
+    cache = loadChunkCache()
+    pool = ThreadPool(options.uploadConcurrency)
+    try:
+        for directory in directories:
+            if os.path.exists(directory) == False:
+                error("invalid directory specified")
+            name = archiveName(directory)
+            index = dedupDirectory(directory, timestamp, pool, cache)
+            targets.append(saveBackupObject(timestamp, "%s.index.json.gz" % name, gzipJson(index)))
+            if not options.skipIntegrity:
+                ## there is no archive, the chunks are named after their sha256 already
+                integrity = {"version": 1, "timestamp": timestamp, "directory": directory, "complete": True, "archive": None,
+                             "files": dict((entry["name"], entry["sha256"]) for entry in index["entries"] if entry["type"] == "file")}
+                targets.append(saveBackupObject(timestamp, "%s.integrity.json.gz" % name, gzipJson(integrity)))
+            targets.append(saveBackupObject(timestamp, "%s.snapshot.json" % name, json.dumps(newSnapshot(directory, timestamp, "dedup"))))
+    finally:
+        pool.close()
+        pool.join()
+    saveChunkCache(cache)
+    if options.stream:
+        return []
+    return targets
+
+def dedupDirectory(directory, timestamp, pool, cache):
+    ## Splits every file into content defined chunks and uploads the chunks that aren't
+    ## in s3 yet. Returns the snapshot index that lists the chunks of every file.
+    started = time.time()
+    entries = []
+    pending = collections.deque()
+    chunkCount = 0
+    size = 0
+    uploaded = 0
+    changed = 0
+    for (path, arcname, st) in scanDirectory(directory):
+        try:
+            if stat.S_ISDIR(st.st_mode):
+                entry = describeEntry(path, arcname, st, "dir")
+            elif stat.S_ISLNK(st.st_mode):
+                entry = describeEntry(path, arcname, st, "symlink")
+                entry["target"] = os.readlink(path)
+            elif stat.S_ISREG(st.st_mode):
+                entry = describeEntry(path, arcname, st, "file")
+                entry["chunks"] = []
+                with open(path, 'rb') as f:
+                    reader = f if options.skipIntegrity else HashingReader(f)
+                    for chunk in chunkFile(reader):
+                        throttleRead(len(chunk))
+                        digest = hashlib.sha256(chunk).hexdigest()
+                        entry["chunks"].append(digest)
+                        chunkCount += 1
+                        size += len(chunk)
+                        if digest in cache:
+                            continue
+                        cache.add(digest)
+                        uploaded += len(chunk)
+                        pending.append(pool.apply_async(putChunk, (digest, chunk)))
+                        while len(pending) >= 2 * options.uploadConcurrency:
+                            pending.popleft().get()
+                    if changedSinceSnapshot(directory, arcname, f):
+                        changed += 1
+                    if reader is not f:
+                        entry["sha256"] = reader.digest.hexdigest()
+            else:
+                log("skipping special file: %s" % path)
+                continue
+        except (IOError, OSError):
+            log("file vanished while chunking: %s" % path)
+            continue
+        entries.append(entry)
+    while pending:
+        pending.popleft().get()
+    elapsed = max(time.time() - started, 0.001)
+    log("deduplicated [%s]: %d bytes in %d chunks, uploaded %d new bytes in %.2fs (%.2f MB/s)" % (directory, size, chunkCount, uploaded, elapsed, size / elapsed / 1048576))
+    REPORT.record("dedup", elapsed, size, len(entries))
+    recordChangedSinceSnapshot(directory, changed)
+    return {"version": 1, "timestamp": timestamp, "directory": directory, "entries": entries}
+
+def describeEntry(path, arcname, st, entryType):
+    return {"name": arcname, "type": entryType, "mode": stat.S_IMODE(st.st_mode), "uid": st.st_uid, "gid": st.st_gid, "mtime": st.st_mtime, "size": st.st_size}
+
+def chunkFile(f):
+    ## content defined chunking: a chunk ends where the top bits of a rolling gear hash
+    ## are all zero, so inserting data only changes the chunks around the insert
+    average = options.chunkSize * 1024
+    minSize = average // 4
+    maxSize = average * 4
+    bits = int(round(math.log(average - minSize, 2)))
+    mask = ((1 << bits) - 1) << (32 - bits)
+    buf = ""
+    eof = False
+    while True:
+        while not eof and len(buf) < maxSize:
+            data = f.read(maxSize - len(buf))
+            if not data:
+                eof = True
+            buf += data
+        if not buf:
+            return
+        cut = findChunkBoundary(buf, minSize, mask)
+        yield buf[:cut]
+        buf = buf[cut:]
+
+def findChunkBoundary(data, minSize, mask):
+    ## nothing before minSize can be a boundary, so the hash starts rolling there
+    h = 0
+    gear = GEAR
+    view = bytearray(data)
+    for i in xrange(minSize, len(view)):
+        h = ((h << 1) + gear[view[i]]) & 0xffffffff
+        if not h & mask:
+            return i + 1
+    return len(view)
+
+def chunkKey(digest):
+    return "%s/chunks/%s/%s" % (options.s3Prefix, digest[:2], digest)
+
+def putChunk(digest, chunk):
+    data = zlib.compress(chunk, 6)
+    throttleUpload(len(data))
+    getThreadBucket().new_key(chunkKey(digest)).set_contents_from_string(data, encrypt_key=True)
+
+def fetchChunk(digest):
+    chunk = zlib.decompress(getThreadBucket().new_key(chunkKey(digest)).get_contents_as_string())
+    if hashlib.sha256(chunk).hexdigest() != digest:
+        error("chunk %s is corrupt" % digest)
+    return chunk
+
+def getChunkCacheFile():
+    if options.dumpDir == None or os.path.isdir(options.dumpDir) == False:
+        return None
+    return "%s/chunk-cache-%s-%s" % (options.dumpDir, options.s3BackupBucket, options.s3Prefix.replace("/", "_"))
+
+def loadChunkCache():
+    ## the cache holds every chunk known to be in s3 so a backup needs no HEAD requests -
+    ## without one it is seeded from a single listing of the chunk namespace
+    cacheFile = getChunkCacheFile()
+    if cacheFile is not None and os.path.exists(cacheFile):
+        with open(cacheFile) as f:
+            return set(line.strip() for line in f if line.strip())
+    log("seeding the chunk cache from s3")
+    return set(key.name.split("/")[-1] for key in getS3BackupBucket().list("%s/chunks/" % options.s3Prefix))
+
+def saveChunkCache(cache):
+    cacheFile = getChunkCacheFile()
+    if cacheFile is None:
+        return
+    with open(cacheFile + ".tmp", 'w') as f:
+        for digest in sorted(cache):
+            f.write("%s\n" % digest)
+    os.rename(cacheFile + ".tmp", cacheFile)
+
+def collectGarbageChunks(backupFiles, keyNames, deletedNames):
+    ## Chunks are reference counted by the indexes of the snapshots that are kept. Chunks
+    ## only lose references when a dedup snapshot goes, so nothing is listed otherwise.
+    if not any(name.endswith(".index.json.gz") for name in deletedNames):
+        return
+    bucket = getS3BackupBucket()
+    references = collections.Counter()
+    for name in keyNames:
+        if name.endswith(".index.json.gz") and dirname(name) in backupFiles:
+            index = readJsonFromS3(name)
+            if index is None:
+                ## without every index, chunks that are still needed could look unreferenced
+                log("[%s] is missing, not collecting unreferenced chunks" % name, logging.WARNING)
+                return
+            for entry in index["entries"]:
+                references.update(entry.get("chunks", []))
+    garbage = [key.name for key in bucket.list("%s/chunks/" % options.s3Prefix) if key.name.split("/")[-1] not in references]
+    if not garbage:
+        return
+    log("deleting %d unreferenced chunks (%d chunks still referenced)" % (len(garbage), len(references)))
+    deleteKeys(garbage)
+    cacheFile = getChunkCacheFile()
+    if cacheFile is not None and os.path.exists(cacheFile):
+        saveChunkCache(loadChunkCache() - set(name.split("/")[-1] for name in garbage))
+
+def scanDirectoryState(directory):
+    ## record the size, mtime, inode (and optionally the sha1) of everything the
+    ## scanner selects, keyed by archive name - along with every entry in archive
+    ## order, so a full baseline can be archived from the same scan
+    dirs = []
+    files = {}
+    members = []
+    for (path, arcname, st) in scanDirectory(directory):
+        if stat.S_ISDIR(st.st_mode):
+            dirs.append((path, arcname))
+            members.append((path, arcname))
+            continue
+        digest = None
+        if options.hashFiles and stat.S_ISREG(st.st_mode):
+            try:
+                digest = hashFile(path)
+            except (IOError, OSError):
+                log("file vanished while scanning: %s" % path)
+                continue
+        files[arcname] = (path, [st.st_size, st.st_mtime, st.st_ino, digest])
+        members.append((path, arcname))
+    return (dirs, files, members)
+
+def scanDirectory(directory, background=False, root=None):
+    ## Walks a directory depth first in the order tar archives it and returns
+    ## [(path, arcname, lstat)] for everything that isn't excluded. Exclusions are
+    ## checked on names before anything is stat'ed, so excluded subtrees are never entered.
+    ## With a root, that copy of the directory is walked instead (names and exclusions
+    ## stay those of the directory) - a backup of a directory with a snapshot gets the
+    ## entries the snapshot was taken from.
+    if not background and root is None and directory in SNAPSHOTS:
+        snapshot = SNAPSHOTS[directory]
+        if snapshot.entries is None:
+            snapshot.entries = scanDirectory(directory, root=snapshot.root)
+        return snapshot.entries
+    started = time.time()
+    matcher = getExcludeMatcher()
+    counts = {"visited": 1, "pruned": 0, "files": 0, "dirs": 1, "bytes": 0}
+    pool = None
+    if options.scanThreads > 1:
+        pool = ThreadPool(options.scanThreads)
+
+    def children(path, arcname, relpath):
+        selected = []
+        for (name, isDir) in listDirectory(path):
+            counts["visited"] += 1
+            childPath = os.path.join(path, name)
+            childRelpath = "%s/%s" % (relpath, name) if relpath else name
+            if matcher.excluded(os.path.join(directory, childRelpath), childRelpath, name, isDir):
+                counts["pruned"] += 1
+                log("skipping file: %s" % childPath, logging.DEBUG)
+                continue
+            selected.append((childPath, "%s/%s" % (arcname, name), childRelpath))
+        paths = [child[0] for child in selected]
+        if pool is not None and len(paths) >= SCAN_PARALLEL_THRESHOLD:
+            stats = pool.map(lstatIfExists, paths)
+        else:
+            stats = map(lstatIfExists, paths)
+        return [(child, st) for (child, st) in zip(selected, stats) if st is not None]
+
+    base = os.path.basename(directory)
+    root = root or directory
+    entries = [(root, base, os.lstat(root))]
+    try:
+        stack = [iter(children(root, base, ""))]
+        while stack:
+            item = next(stack[-1], None)
+            if item is None:
+                stack.pop()
+                continue
+            ((path, arcname, relpath), st) = item
+            log("adding file: %s" % path, logging.DEBUG)
+            entries.append((path, arcname, st))
+            if stat.S_ISDIR(st.st_mode):
+                counts["dirs"] += 1
+                stack.append(iter(children(path, arcname, relpath)))
+            else:
+                counts["files"] += 1
+                if stat.S_ISREG(st.st_mode):
+                    counts["bytes"] += st.st_size
+    finally:
+        if pool is not None:
+            pool.terminate()
+    elapsed = max(time.time() - started, 0.001)
+    ## background scans (the daemon looking for changes) aren't part of any backup
+    log("scanned [%s]: visited %d entries, pruned %d, selected %d files and %d directories (%d bytes) in %.2fs (%.0f entries/s)" % (directory, counts["visited"], counts["pruned"], counts["files"], counts["dirs"], counts["bytes"], elapsed, counts["visited"] / elapsed),
+        logging.DEBUG if background else logging.INFO)
+    if not background:
+        REPORT.record("scan", elapsed, counts["bytes"], counts["files"])
+    return entries
+
+def listDirectory(path):
+    ## [(name, isDir)] sorted by name - scandir knows the types without a stat call
+    try:
+        if scandir is not None:
+            names = [(entry.name, entry.is_dir(follow_symlinks=False)) for entry in scandir(path)]
+        else:
+            names = [(name, stat.S_ISDIR(os.lstat(os.path.join(path, name)).st_mode)) for name in os.listdir(path)]
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        log("directory vanished while scanning: %s" % path)
+        return []
+    return sorted(names)
+
+def lstatIfExists(path):
+    throttleRead(SCAN_ENTRY_COST)
+    try:
+        return os.lstat(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        log("file vanished while scanning: %s" % path)
+        return None
+
+class LocalSnapshot(object):
+    ## A point in time copy of a --directory tree that its backup is archived from. A reflink
+    ## snapshot clones the files, a hardlink snapshot shares them with the live tree - those
+    ## are compared with their size and mtime at the time of the snapshot when they are read,
+    ## so files written to in place since are caught. A hook snapshot is made by a script.
+    def __init__(self, directory, root, method):
+        self.directory = directory
+        self.root = root
+        self.method = method
+        ## the scan of the directory, with the paths inside the snapshot
+        self.entries = None
+        ## arcname -> lstat of the original, for the entries that are copies
+        self.stats = {}
+        ## arcname -> (size, mtime) when the snapshot was taken, for the files shared with the live tree
+        self.frozen = {}
+
+def snapshotRoot(directory):
+    if options.snapshotDir:
+        return os.path.join(options.snapshotDir, archiveName(directory))
+    return os.path.join(os.path.dirname(directory), ".%s.snapshot" % os.path.basename(directory))
+
+def takeSnapshots(directories):
+    ## runs while the directories are frozen, so it only does what the copy needs
+    for directory in directories:
+        started = time.time()
+        root = snapshotRoot(directory)
+        if (os.path.realpath(root) + "/").startswith(os.path.realpath(directory).rstrip("/") + "/"):
+            error("the snapshot of [%s] can't go inside it [%s], set --snapshot-dir" % (directory, root))
+        if not os.path.isdir(os.path.dirname(root)):
+            os.makedirs(os.path.dirname(root))
+        if options.snapshot == "hook":
+            hookSnapshot(directory, root)
+        else:
+            linkSnapshot(directory, root, options.snapshot)
+        snapshot = SNAPSHOTS[directory]
+        elapsed = time.time() - started
+        log("took a %s snapshot of [%s] at [%s] in %.2fs" % (snapshot.method, directory, root, elapsed))
+        REPORT.record("snapshot", elapsed, 0, len(snapshot.entries or []))
+
+def linkSnapshot(directory, root, method):
+    ## the entries are scanned while the directory is frozen and the snapshot is made of
+    ## exactly those, so the backup archives them without scanning the copy again
+    entries = scanDirectory(directory)
+    if os.path.lexists(root):
+        log("removing the snapshot an earlier run left behind [%s]" % root, logging.WARNING)
+        shutil.rmtree(root)
+    snapshot = LocalSnapshot(directory, root, method)
+    snapshot.entries = []
+    SNAPSHOTS[directory] = snapshot
+    base = entries[0][1]
+    clones = {}
+    for (path, arcname, st) in entries:
+        target = root + arcname[len(base):]
+        if stat.S_ISDIR(st.st_mode):
+            ## only for the backup to read - the archive gets the mode and owner of the original
+            os.mkdir(target, 0700)
+            snapshot.stats[arcname] = st
+            snapshot.entries.append((target, arcname, st))
+            continue
+        try:
+            if stat.S_ISREG(st.st_mode) and snapshot.method != "hardlink" and cloneFile(snapshot, path, target, st, clones):
+                snapshot.stats[arcname] = st
+            else:
+                linkFile(directory, path, target)
+                if stat.S_ISREG(st.st_mode):
+                    snapshot.frozen[arcname] = (st.st_size, st.st_mtime)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            log("file vanished while taking the snapshot: %s" % path)
+            continue
+        snapshot.entries.append((target, arcname, st))
+
+def cloneFile(snapshot, path, target, st, clones):
+    ## a copy on write clone of the file (other names of it become hard links to the clone).
+    ## False when the filesystem can't clone and --snapshot auto falls back to hard links
+    key = (st.st_dev, st.st_ino)
+    if key in clones:
+        os.link(clones[key], target)
+        return True
+    try:
+        with open(path, 'rb') as source:
+            fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+            try:
+                fcntl.ioctl(fd, FICLONE, source.fileno())
+            finally:
+                os.close(fd)
+    except IOError as e:
+        if e.errno not in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY):
+            raise
+        os.unlink(target)
+        if snapshot.method == "reflink":
+            error("[%s] can't be cloned into [%s] (%s) - try --snapshot hardlink" % (path, target, e.strerror))
+        log("[%s] can't be cloned into [%s] (%s), using hard links instead" % (path, target, e.strerror), logging.WARNING)
+        snapshot.method = "hardlink"
+        return False
+    if st.st_nlink > 1:
+        clones[key] = target
+    return True
+
+def linkFile(directory, path, target):
+    try:
+        os.link(path, target)
+    except OSError as e:
+        if e.errno == errno.EXDEV:
+            error("the snapshot of [%s] has to be on its filesystem for hard links, set --snapshot-dir" % directory)
+        raise
+
+def hookSnapshot(directory, root):
+    ## the script makes the snapshot (an lvm or btrfs one, say) appear at root - the scan
+    ## of it is left to the backup, once the directories aren't frozen anymore
+    if not options.snapshotScript:
+        error("--snapshot hook needs a --snapshot-script")
+    if os.path.lexists(root) and (not os.path.isdir(root) or os.listdir(root)):
+        error("[%s] is in the way of the snapshot of [%s], was an earlier one not released?" % (root, directory))
+    if not os.path.isdir(root):
+        os.mkdir(root, 0700)
+    SNAPSHOTS[directory] = LocalSnapshot(directory, root, "hook")
+    rc = runScript(options.snapshotScript, args=["create", directory, root])
+    if rc != 0:
+        error("snapshot script exited with code [%d] for [%s]" % (rc, directory))
+
+def releaseSnapshots():
+    ## a snapshot that can't be released is left behind with a warning, the backup is done
+    for (directory, snapshot) in SNAPSHOTS.items():
+        del SNAPSHOTS[directory]
+        try:
+            if snapshot.method == "hook":
+                rc = runScript(options.snapshotScript, args=["release", directory, snapshot.root])
+                if rc != 0:
+                    raise Exception("snapshot script exited with code [%d]" % rc)
+                os.rmdir(snapshot.root)
+            else:
+                shutil.rmtree(snapshot.root)
+            log("released the snapshot of [%s]" % directory)
+        except Exception:
+            log("couldn't release the snapshot of [%s] at [%s]: %s" % (directory, snapshot.root, traceback.format_exc()), logging.WARNING)
+
+def changedSinceSnapshot(directory, arcname, fileobj):
+    ## true for a file shared with the live tree by a hardlink snapshot that was written to
+    ## after the snapshot was taken - the backup has it as it was read, not as it was then
+    snapshot = SNAPSHOTS.get(directory)
+    if snapshot is None or arcname not in snapshot.frozen:
+        return False
+    st = os.fstat(fileobj.fileno())
+    if (st.st_size, st.st_mtime) == snapshot.frozen[arcname]:
+        return False
+    log("[%s] was written to after the snapshot was taken" % arcname, logging.WARNING)
+    return True
+
+def recordChangedSinceSnapshot(directory, count):
+    if count:
+        log("%d files of [%s] were written to after the snapshot was taken" % (count, directory), logging.WARNING)
+        REPORT.record("changed-after-snapshot", 0, 0, count)
+
+def getExcludeMatcher():
+    ## cached
+    global EXCLUDE_MATCHER
+    if EXCLUDE_MATCHER is None:
+        EXCLUDE_MATCHER = ExcludeMatcher(options.excludes, options.excludeGlobs)
+    return EXCLUDE_MATCHER
+
+class ExcludeMatcher(object):
+    ## Every --exclude regex (matched from the start of the full path) and --exclude-glob
+    ## pattern, compiled once into a handful of combined regexes.
+    def __init__(self, regexes, globs):
+        self.regex = combineRegexes(["(?:%s)" % regex for regex in regexes])
+        patterns = {"names": [], "paths": [], "dirNames": [], "dirPaths": []}
+        for glob in globs:
+            dirOnly = glob.endswith("/")
+            glob = glob.rstrip("/")
+            ## a slash anywhere but the end anchors the pattern to the top of the directory
+            kind = "paths" if "/" in glob else "names"
+            if dirOnly:
+                kind = "dir" + kind[0].upper() + kind[1:]
+            patterns[kind].append("(?:%s)\\Z" % globToRegex(glob.lstrip("/")))
+        self.names = combineRegexes(patterns["names"])
+        self.paths = combineRegexes(patterns["paths"])
+        self.dirNames = combineRegexes(patterns["dirNames"])
+        self.dirPaths = combineRegexes(patterns["dirPaths"])
+
+    def excluded(self, path, relpath, name, isDir):
+        for (matcher, value) in ((self.regex, path), (self.names, name), (self.paths, relpath)):
+            if matcher is not None and matcher.match(value):
+                return True
+        if isDir:
+            for (matcher, value) in ((self.dirNames, name), (self.dirPaths, relpath)):
+                if matcher is not None and matcher.match(value):
+                    return True
+        return False
+
+def combineRegexes(regexes):
+    if not regexes:
+        return None
+    return re.compile("|".join(regexes))
+
+def globToRegex(glob):
+    ## * and ? stay within one path component, **/ matches any number of directories
+    regex = []
+    i = 0
+    while i < len(glob):
+        if glob.startswith("**/", i):
+            regex.append("(?:.*/)?")
+            i += 3
+        elif glob.startswith("**", i):
+            regex.append(".*")
+            i += 2
+        elif glob[i] == "*":
+            regex.append("[^/]*")
+            i += 1
+        elif glob[i] == "?":
+            regex.append("[^/]")
+            i += 1
+        elif glob[i] == "[" and glob.find("]", i + 1) > i + 1:
+            end = glob.find("]", i + 1)
+            chars = glob[i + 1:end]
+            if chars.startswith("!"):
+                chars = "^" + chars[1:]
+            regex.append("[%s]" % chars.replace("\\", "\\\\"))
+            i = end + 1
+        else:
+            regex.append(re.escape(glob[i]))
+            i += 1
+    return "".join(regex)
+
+def hashFile(path, algorithm="sha1"):
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(COMPRESS_BLOCK_SIZE), ""):
+            throttleRead(len(block))
+            digest.update(block)
+    return digest.hexdigest()
+
+def getLatestSnapshot(name):
+    snapshots = loadCatalog()["snapshots"]
+    for timestamp in sorted(snapshots, reverse=True):
+        if name in snapshots[timestamp]["directories"]:
+            return snapshots[timestamp]["directories"][name]
+    return None
+
+def gzipJson(value):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(json.dumps(value)) + compressor.flush()
+
+def readJsonFromS3(s3_key):
+    ## returns None when the object doesn't exist
+    key = getS3BackupBucket().get_key(s3_key)
+    if key is None:
+        return None
+    data = key.get_contents_as_string()
+    if s3_key.endswith(".gz"):
+        data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    return json.loads(data)
+
+def saveBackupObject(timestamp, basename, data):
+    ## small objects that belong to a snapshot are put straight to s3 when streaming,
+    ## otherwise they are staged in the dump dir and uploaded with the archives
+    if options.stream:
+        s3_key = "%s/%s/%s" % (options.s3Prefix, timestamp, basename)
+        log("putting s3 key: %s" % s3_key)
+        getS3BackupBucket().new_key(s3_key).set_contents_from_string(data, encrypt_key=True)
+        return s3_key
+    filename = "%s/%s" % (options.dumpDir, basename)
+    with open(filename, 'wb') as f:
+        f.write(data)
+    return filename
+
+def archiveDirectoryJob(job):
+    ## jobs run in a pool process hand their part of the run report back with the result
+    global REPORT
+    inChild = multiprocessing.current_process().name != "MainProcess"
+    if inChild:
+        REPORT = RunReport()
+    try:
+        (target, offsets, integrity) = archiveDirectory(*job)
+    finally:
+        if inChild:
+            flushLog()
+    return (target, offsets, integrity, REPORT.phases if inChild else None)
+
+def archiveDirectory(directory, target, threads, members=None):
+    ## tar and compress a directory into a local file or, when streaming, straight into an s3 key
+    started = time.time()
+    if options.stream:
+        log("streaming to s3_backup_key: %s" % target)
+        out = S3StreamWriter(target)
+    else:
+        log("creating file: %s" % target)
+        out = open(target, 'wb')
+    digests = None
+    if not options.skipIntegrity:
+        ## the parts are those of the upload, streamed or not (unless it takes more than 10000)
+        digests = DigestWriter(out, getPartSize(0))
+        if options.stream:
+            out.partDigests = digests.parts
+    gz = ParallelCompressWriter(digests or out, threads, getCodec(options.codec), options.compressLevel)
+    try:
+        if members is None:
+            members = [(path, arcname) for (path, arcname, st) in scanDirectory(directory)]
+        compressStarted = time.time()
+        ## not a "w|" stream - that buffers in front of the writer, and the adaptive level
+        ## changes have to land exactly where the data of a file starts
+        with closing(IndexedTarFile.open(fileobj=gz, mode="w")) as tar:
+            if options.adaptiveCompression and gz.codec.storeLevel != gz.defaultLevel:
+                tar.compressor = gz
+            tar.snapshot = SNAPSHOTS.get(directory)
+            if digests is not None:
+                tar.digests = {}
+            for (path, arcname) in members:
+                try:
+                    tar.add(path, arcname=arcname, recursive=False)
+                except (IOError, OSError):
+                    log("file vanished while archiving: %s" % path)
+        gz.close()
+        ## before the stream sends its last part, which needs the md5 of it
+        if digests is not None:
+            digests.finish()
+    except:
+        gz.abort()
+        if options.stream:
+            out.abort()
+        else:
+            out.close()
+        raise
+    out.close()
+    elapsed = max(time.time() - started, 0.001)
+    log("created archive [%s]: %d bytes compressed to %d (%.1f%%) in %.2fs (%.2f MB/s with %d threads)" % (target, gz.size, gz.compressedSize, 100.0 * gz.compressedSize / max(gz.size, 1), elapsed, gz.size / elapsed / 1048576, threads))
+    if tar.compressor is not None:
+        log("stored %d bytes of incompressible files in [%s] without compressing them" % (gz.storedSize, target))
+    REPORT.record("compress", time.time() - compressStarted, gz.size, len(members))
+    recordChangedSinceSnapshot(directory, tar.changed)
+    ## where every member starts in the tar stream and where every compressed block starts in
+    ## the archive is enough to fetch and extract single members later
+    offsets = {"version": 1, "archive": os.path.basename(target), "codec": gz.codec.name, "size": gz.size, "compressedSize": gz.compressedSize,
+               "blocks": gz.blocks, "members": tar.memberOffsets,
+               "links": tar.memberLinks}
+    ## the sha256 of every file and of the archive, and the md5 of every part of its upload
+    integrity = None
+    if digests is not None:
+        multipart = options.stream or digests.size >= digests.partSize
+        integrity = {"version": 1, "directory": directory, "complete": True, "files": tar.digests,
+                     "archive": digests.summary(os.path.basename(target), multipart)}
+    return (target, offsets, integrity)
+
+class HashingReader(object):
+    ## a file object that keeps a sha256 of what is read from it, so a file is checksummed
+    ## by the same read that archives it
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.digest.update(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+class IndexedTarFile(tarfile.TarFile):
+    ## Records the offset and length (headers included) of every member in the tar stream,
+    ## and the target of every hard link. With a snapshot set, it is archived as the
+    ## original directory. With digests set, the sha256 of every file goes there.
+    ## With a compressor set, large files that don't compress are written at its store level.
+    def __init__(self, *args, **kwargs):
+        tarfile.TarFile.__init__(self, *args, **kwargs)
+        self.memberOffsets = []
+        self.memberLinks = {}
+        self.compressor = None
+        self.snapshot = None
+        self.changed = 0
+        self.digests = None
+
+    def gettarinfo(self, name=None, arcname=None, fileobj=None):
+        ## the copies in a snapshot are archived with the owner, mode and mtime of the original
+        tarinfo = tarfile.TarFile.gettarinfo(self, name, arcname, fileobj)
+        st = self.snapshot.stats.get(arcname) if self.snapshot is not None else None
+        if tarinfo is not None and st is not None:
+            tarinfo.mode = st.st_mode
+            tarinfo.mtime = st.st_mtime
+            if (tarinfo.uid, tarinfo.gid) != (st.st_uid, st.st_gid):
+                (tarinfo.uid, tarinfo.gid) = (st.st_uid, st.st_gid)
+                try:
+                    tarinfo.uname = pwd.getpwuid(st.st_uid)[0]
+                except KeyError:
+                    tarinfo.uname = ""
+                try:
+                    tarinfo.gname = grp.getgrgid(st.st_gid)[0]
+                except KeyError:
+                    tarinfo.gname = ""
+        return tarinfo
+
+    def addfile(self, tarinfo, fileobj=None):
+        store = self.compressor is not None and fileobj is not None and tarinfo.size >= ADAPTIVE_MIN_SIZE and isIncompressible(fileobj, tarinfo.size)
+        if store:
+            self.compressor.setLevel(self.compressor.codec.storeLevel)
+        if self.digests is not None and fileobj is not None:
+            fileobj = HashingReader(fileobj)
+        offset = self.offset
+        tarfile.TarFile.addfile(self, tarinfo, fileobj)
+        self.memberOffsets.append((tarinfo.name, offset, self.offset - offset))
+        if self.digests is not None and fileobj is not None:
+            self.digests[tarinfo.name] = fileobj.digest.hexdigest()
+        elif self.digests is not None and tarinfo.islnk():
+            self.digests[tarinfo.name] = self.digests.get(tarinfo.linkname)
+        if self.snapshot is not None and fileobj is not None and changedSinceSnapshot(self.snapshot.directory, tarinfo.name, fileobj):
+            self.changed += 1
+        if tarinfo.islnk():
+            self.memberLinks[tarinfo.name] = tarinfo.linkname
+        if store:
+            self.compressor.setLevel(self.compressor.defaultLevel)
+
+def connectS3():
+    return boto.s3.connect_to_region(options.s3BackupRegion, calling_format=OrdinaryCallingFormat())
 
 def getS3BackupBucket():
     # Returns the boto S3 Bucket object being used for backups
-    log("connecting to region: %s" % options.s3BackupRegion)
-    log("connecting to bucket: %s" % options.s3BackupBucket)
-    return s3.get_bucket(options.s3BackupBucket)
+    ## cached - the shared connection is only used from the main thread, every other
+    ## thread (compression, restore and upload workers) gets its own
+    global BACKUP_BUCKET
+    if threading.current_thread().name != "MainThread":
+        return getThreadBucket()
+    with BUCKET_LOCK:
+        if BACKUP_BUCKET is None:
+            log("connecting to region: %s" % options.s3BackupRegion)
+            log("connecting to bucket: %s" % options.s3BackupBucket)
+            BACKUP_BUCKET = s3.get_bucket(options.s3BackupBucket)
+    return BACKUP_BUCKET
+
+def getThreadBucket():
+    ## boto connections are not thread safe, so every worker thread gets its own
+    ## connection and keeps reusing it for everything that thread sends
+    bucket = getattr(THREAD_STATE, "bucket", None)
+    if bucket is None:
+        bucket = connectS3().get_bucket(options.s3BackupBucket, validate=False)
+        THREAD_STATE.bucket = bucket
+    return bucket
+
+def getDownloadPool():
+    ## cached - every range reader of the process shares these threads, so their s3
+    ## connections are set up once instead of once per archive or span
+    global DOWNLOAD_POOL
+    with BUCKET_LOCK:
+        if DOWNLOAD_POOL is None:
+            DOWNLOAD_POOL = ThreadPool(max(options.restoreConcurrency, 1) * max(len(options.backupDirectories), 1))
+    return DOWNLOAD_POOL
+
+def getThreadMultipartUpload(mp):
+    ## bind an existing multipart upload to the calling thread's connection
+    threadMp = MultiPartUpload(getThreadBucket())
+    threadMp.key_name = mp.key_name
+    threadMp.id = mp.id
+    return threadMp
 
 def getAllBackupBucketMatchingFiles():
-    backup_files = sorted(getS3BackupBucket().list(options.s3Prefix+"/"), reverse=True, key=lambda s3_key: s3_key.name)
+    keys = []
+    for backup_key in getS3BackupBucket().list(options.s3Prefix+"/"):
+        ## the catalog and the chunk namespace sort after every timestamp, so the listing can stop there
+        if backup_key.name.startswith(getCatalogKey()) or backup_key.name.startswith("%s/chunks/" % options.s3Prefix):
+            break
+        keys.append(backup_key)
+    backup_files = sorted(keys, reverse=True, key=lambda s3_key: s3_key.name)
     allFiles = []
     x = 0;
     for backup_key in backup_files:
@@ -241,131 +2046,804 @@ def getAllBackupBucketMatchingFiles():
     return allFiles
 
 def getBackupFiles():
+    ## Get a sorted list of backup files and arranged by how old they are (hourly, daily, weekly, monthly)
+    return bucketSnapshots(sorted(("%s/%s" % (options.s3Prefix, timestamp) for timestamp in loadCatalog()["snapshots"]), reverse=True))
+
+def getCatalogKey():
+    return "%s/catalog.json.gz" % options.s3Prefix
+
+def loadCatalog():
+    ## The catalog lists every snapshot with its members (size and etag) and the snapshot
+    ## metadata of every directory, so runs read one object instead of listing the prefix.
+    ## cached
+    global CATALOG
+    if CATALOG is None:
+        CATALOG = readJsonFromS3(getCatalogKey())
+        if CATALOG is None or CATALOG["version"] != 1:
+            log("no usable catalog in s3, rebuilding it")
+            CATALOG = rebuildCatalog()
+    return CATALOG
+
+def rebuildCatalog():
+    global CATALOG
+    catalog = {"version": 1, "generation": 0, "snapshots": {}}
+    for backup_key in getAllBackupBucketMatchingFiles():
+        addToCatalog(catalog, backup_key)
+    ## --dry-run, --restore and --verify never write to s3, they just use the rebuilt catalog for this run
+    if (options.dryRun or options.restore or options.verify) and not options.rebuildCatalog:
+        log("not saving the rebuilt catalog, this run doesn't write to s3")
+    else:
+        saveCatalog(catalog)
+    CATALOG = catalog
+    return catalog
+
+def addSnapshotToCatalog(timestamp):
+    ## listing just the new snapshot picks up the sizes and etags of everything that was uploaded
+    catalog = loadCatalog()
+    for backup_key in getS3BackupBucket().list("%s/%s/" % (options.s3Prefix, timestamp)):
+        addToCatalog(catalog, backup_key)
+    saveCatalog(catalog)
+
+def addToCatalog(catalog, backup_key):
+    (timestamp, member) = backup_key.name.split("/")[-2:]
+    snapshot = catalog["snapshots"].setdefault(timestamp, {"members": {}, "directories": {}})
+    snapshot["members"][member] = {"size": backup_key.size, "etag": backup_key.etag.strip('"')}
+    if member.endswith(".snapshot.json"):
+        snapshot["directories"][member[:-len(".snapshot.json")]] = readJsonFromS3(backup_key.name)
+
+def saveCatalog(catalog):
+    ## a put replaces the whole object at once, so readers see either the old or the new catalog
+    catalog["generation"] += 1
+    catalog["updated"] = datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
+    getS3BackupBucket().new_key(getCatalogKey()).set_contents_from_string(gzipJson(catalog), encrypt_key=True)
+    log("saved catalog generation %d with %d snapshots" % (catalog["generation"], len(catalog["snapshots"])))
+
+def getCatalogKeyNames(catalog):
+    return ["%s/%s/%s" % (options.s3Prefix, timestamp, member) for (timestamp, snapshot) in catalog["snapshots"].iteritems() for member in snapshot["members"]]
+
+def bucketSnapshots(prefixes):
     ## this is the heart of the cleanup process.
-    ## logic:
+    ## logic (prefixes come in newest first):
     ## get the latest hourlys
-    ##   get the latest daily's that are not part of the hourlys
-    ##     get the latest weeklys that are not part of the hourlys or dailys
-    ##       get the latest monthlys that are not part of the hourlys or dailys or weeklys
-    ##         get the latest yearlys that are not part of the hourlys or dailys or weeklys or monthlys
-    ## Get a sorted list of backup files and arranged by how old they are (hourly, daily, weekly, monthly)
-    backup_files = getAllBackupBucketMatchingFiles()
-    backup_list={"hourly": [], "daily": [], "weekly": [], "monthly": [], "yearly": [], "other": []}
-    backup_date_list={"hourly": [], "daily": [], "weekly": [], "monthly": [], "yearly": []}
-    for backup_key in backup_files:
-        date_ext=backup_key.name.split("/")[-2]
-        key_dir = dirname(backup_key.name)
-        (year, month, day, hour, mins, sec) = date_ext.split("-")
-        for time_interval in backup_list:
-            if time_interval == "hourly":
-                backup_date=datetime.datetime(int(year), int(month), int(day), int(hour), int(1), int(1))
-                if backup_date not in backup_date_list[time_interval]:
-                    backup_list[time_interval].append(key_dir)
-                    backup_date_list[time_interval].append(backup_date)
-            if time_interval == "daily":
-                backup_date=datetime.datetime(int(year), int(month), int(day), int(1), int(1), int(1))
-                if backup_date not in backup_date_list[time_interval]:
-                    backup_list[time_interval].append(key_dir)
-                    backup_date_list[time_interval].append(backup_date)
-            if time_interval == "weekly":
-                if int(day) % 7 == 0:
-                    backup_date=datetime.datetime(int(year), int(month), int(day), int(1), int(1), int(1))
-                    if backup_date not in backup_date_list[time_interval]:
-                        backup_list[time_interval].append(key_dir)
-                        backup_date_list[time_interval].append(backup_date)
-            if time_interval == "monthly":
-                backup_date=datetime.datetime(int(year), int(month), int(1), int(1), int(1), int(1))
-                if backup_date not in backup_date_list[time_interval]:
-                    backup_list[time_interval].append(key_dir)
-                    backup_date_list[time_interval].append(backup_date)
-            if time_interval == "yearly":
-                backup_date=datetime.datetime(int(year), int(1), int(1), int(1), int(1), int(1))
-                if backup_date not in backup_date_list[time_interval]:
-                    backup_list[time_interval].append(key_dir)
-                    backup_date_list[time_interval].append(backup_date)
-    return backup_list
-
-def cleanupOldBackups(hourly=25, daily=8, weekly=6, monthly=6, yearly=5):
-    bucket = getS3BackupBucket()
+    ##   get the latest daily's
+    ##     get the latest weeklys (days that are a multiple of 7)
+    ##       get the latest monthlys
+    ##         get the latest yearlys
+    ## a snapshot claims every slot it is the newest snapshot of, so it can be in several lists
+    buckets = dict((interval, []) for interval in RETENTION_INTERVALS)
+    seen = dict((interval, set()) for interval in RETENTION_INTERVALS)
+    for prefix in prefixes:
+        (year, month, day, hour, mins, sec) = prefix.split("/")[-1].split("-")
+        slots = {"hourly": (year, month, day, hour), "daily": (year, month, day), "weekly": (year, month, day),
+                 "monthly": (year, month), "yearly": year}
+        if int(day) % 7 != 0:
+            del slots["weekly"]
+        for interval, slot in slots.iteritems():
+            if slot not in seen[interval]:
+                seen[interval].add(slot)
+                buckets[interval].append(prefix)
+    return buckets
+
+def planRetention(keyNames, rollingPattern, getDependencies=None):
+    ## Plans a cleanup from a single listing of key names without touching s3. The keys
+    ## are grouped by snapshot, the newest <n> snapshots of every kind are kept (plus
+    ## the snapshots they depend on, when getDependencies(prefix, keyNames) is given) and
+    ## every key of every other snapshot is deleted.
+    snapshots = {}
+    for name in keyNames:
+        snapshots.setdefault(dirname(name), []).append(name)
+    buckets = bucketSnapshots(sorted(snapshots, reverse=True))
+    keep = set()
+    for (interval, count) in zip(RETENTION_INTERVALS, rollingPattern.split(",")):
+        keep.update(buckets[interval][0:int(count)])
+    if getDependencies is not None:
+        for prefix in list(keep):
+            keep.update(needed for needed in getDependencies(prefix, snapshots[prefix]) if needed in snapshots)
+    delete = dict((prefix, names) for (prefix, names) in snapshots.iteritems() if prefix not in keep)
+    return {"keep": sorted(keep, reverse=True), "delete": delete}
+
+def getSnapshotDependencies(prefix, keyNames):
+    ## incremental snapshots can't be restored without the snapshots they build on
+    ## and directories the daemon carried over unchanged live in the snapshot they were taken in
+    needed = set()
+    for snapshot in loadCatalog()["snapshots"][prefix.split("/")[-1]]["directories"].itervalues():
+        needed.update("%s/%s" % (options.s3Prefix, timestamp) for timestamp in snapshot["chain"] + [snapshot["timestamp"]])
+    return needed
+
+def cleanupOldBackups(dryRun=False):
     ## Keeps one days worth of hourly backups, one week of daily backups, one month of weekly backups, and one year of monthly backups
-    ## logic:
-    ##  get now through $hourly hours ago
-    ##  get (now through $hourly hours) through (now - daily days)
-    ##    iterate through all and keep newest of each day stamp
-    ##  get (now through $daily days) through (now - monthly days)
-    ##    iterate through all and keep newest of each month up to $montly
-    ##  get (now thorugh $monthly months) through (now - yearly years)
-    ##    iterate through all and keep the newset of each year up to $yearly
+    ## (or whatever --rolling-pattern asks for) - everything is planned from a single listing
 
     log("Cleaning up older backup files that are no longer needed.")
-    allBackupFiles = getAllBackupBucketMatchingFiles() ## this is a list of all files
-    ## now we need to limit the ones to keep based on policy,
-    ## put them all into a list and delete the ones that don't match.
-    backupFiles = filterBackupFiles(getBackupFiles())
-    
-    for f in allBackupFiles:
-        bFile = dirname(f.name)
-        if bFile not in backupFiles:
+    started = time.time()
+    catalog = loadCatalog()
+    keyNames = getCatalogKeyNames(catalog) ## this is a list of all files
+    plan = planRetention(keyNames, options.rollingPattern, getSnapshotDependencies)
+    deleteNames = [name for names in plan["delete"].itervalues() for name in names]
+    log("keeping %d snapshots, deleting %d snapshots (%d keys)" % (len(plan["keep"]), len(plan["delete"]), len(deleteNames)))
+    if dryRun:
+        print json.dumps({"keep": plan["keep"], "delete": sorted(plan["delete"], reverse=True), "deleteKeys": len(deleteNames)}, indent=2)
+        return
+    for prefix in sorted(plan["delete"]):
+        log("deleting old backup: %s" % prefix, logging.DEBUG)
+    failed = deleteKeys(deleteNames)
+    ## keys that couldn't be deleted stay in the catalog, so the next cleanup tries them again
+    for (prefix, names) in plan["delete"].iteritems():
+        snapshot = catalog["snapshots"][prefix.split("/")[-1]]
+        for name in names:
+            if name not in failed:
+                del snapshot["members"][name.split("/")[-1]]
+        if not snapshot["members"]:
+            del catalog["snapshots"][prefix.split("/")[-1]]
+    if plan["delete"]:
+        saveCatalog(catalog)
+    collectGarbageChunks(set(plan["keep"]), keyNames, deleteNames)
+    REPORT.record("cleanup", time.time() - started, 0, len(deleteNames))
+
+def deleteKeys(names):
+    ## s3 deletes up to 1000 keys per request - the batches are sent in parallel.
+    ## Returns the set of keys that couldn't be deleted.
+    batches = [names[i:i + 1000] for i in range(0, len(names), 1000)]
+    if not batches:
+        return set()
+    pool = ThreadPool(min(options.uploadConcurrency, len(batches)))
+    try:
+        return set(name for failed in pool.map(deleteKeyBatch, batches) for name in failed)
+    finally:
+        pool.close()
+        pool.join()
+
+def deleteKeyBatch(names):
+    try:
+        result = getThreadBucket().delete_keys(names, quiet=True)
+        for failure in result.errors:
+            log("Couldn't delete %s from s3: %s" % (failure.key, failure.message), logging.WARNING)
+        return [failure.key for failure in result.errors]
+    except:
+        log("Couldn't delete %d keys from s3 starting at %s.  Exception: %s" % (len(names), names[0], traceback.format_exc()), logging.WARNING)
+        return names
+
+def discardSnapshot(timestamp):
+    ## A run that failed before its snapshot made it into the catalog deletes whatever it
+    ## already put in s3 - retention only knows the catalog, so it would never find them.
+    try:
+        names = [key.name for key in getS3BackupBucket().list("%s/%s/" % (options.s3Prefix, timestamp))]
+        log("discarding the %d keys of the incomplete snapshot %s" % (len(names), timestamp), logging.WARNING)
+        deleteKeys(names)
+    except:
+        log("Couldn't discard the incomplete snapshot %s.  Exception: %s" % (timestamp, traceback.format_exc()), logging.WARNING)
+
+def getPartSize(source_size):
+    ## s3 wants parts of at least 5MB and no more than 10000 of them
+    part_size = max(options.uploadPartSize, 5) * 1024 * 1024
+    return max(part_size, int(math.ceil(source_size / 10000.0)))
+
+class UploadPool(object):
+    ## Upload worker threads shared by every multipart upload of the process. Each worker
+    ## keeps its own s3 connection for as long as the process runs, and the bounded queue
+    ## makes submit() block while every worker is busy - however many uploads are going,
+    ## at most 2 * concurrency parts are waiting or being sent.
+    def __init__(self, concurrency):
+        self.pid = os.getpid()
+        self.concurrency = max(concurrency, 1)
+        self.queue = Queue.Queue(maxsize=self.concurrency)
+        for i in range(self.concurrency):
+            worker = threading.Thread(target=self.work, name="upload-%d" % i)
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, uploader, part_num, openPart, size):
+        self.queue.put((uploader, part_num, openPart, size))
+
+    def work(self):
+        while True:
+            (uploader, part_num, openPart, size) = self.queue.get()
+            uploader.sendPart(part_num, openPart, size)
+
+def getUploadPool():
+    ## cached per process - forked processes don't inherit the worker threads
+    global UPLOAD_POOL
+    with BUCKET_LOCK:
+        if UPLOAD_POOL is None or UPLOAD_POOL.pid != os.getpid():
+            UPLOAD_POOL = UploadPool(options.uploadConcurrency)
+    return UPLOAD_POOL
+
+class MultipartUploader(object):
+    ## Sends the parts of one s3 multipart upload through the upload pool. Each part is
+    ## handed over as a callable that opens a fresh file-like object for it, so a failed
+    ## part can be retried from the start. submit() blocks while all workers are busy,
+    ## which keeps the amount of pending data bounded.
+    def __init__(self, s3_key):
+        self.s3Key = s3_key
+        self.pool = getUploadPool()
+        self.concurrency = self.pool.concurrency
+        self.mp = getS3BackupBucket().initiate_multipart_upload(s3_key, encrypt_key=True)
+        self.lock = threading.Condition()
+        self.outstanding = 0
+        self.failure = None
+        self.aborted = False
+        self.partCount = 0
+        self.bytesUploaded = 0
+        ## part number -> md5 of the part, handed over or worked out before sending it
+        self.partMd5s = {}
+        self.started = time.time()
+
+    def submit(self, part_num, openPart, size, md5=None):
+        if self.failure is not None:
+            self.abort()
+            error("upload of [%s] failed: %s" % (self.s3Key, self.failure))
+        with self.lock:
+            self.outstanding += 1
+            if md5 is not None:
+                self.partMd5s[part_num] = md5
+        self.pool.submit(self, part_num, openPart, size)
+
+    def sendPart(self, part_num, openPart, size):
+        ## runs on an upload worker and never raises, so the worker lives on
+        try:
+            ## once a part has failed for good (or the upload was aborted) the rest are dropped
+            if self.failure is None and not self.aborted:
+                self.uploadPart(getThreadMultipartUpload(self.mp), part_num, openPart, size)
+        except Exception as e:
+            log("giving up on part %d of [%s]: %s" % (part_num, self.s3Key, traceback.format_exc()), logging.WARNING)
+            self.failure = e
+        finally:
+            with self.lock:
+                self.outstanding -= 1
+                self.lock.notify_all()
+
+    def uploadPart(self, mp, part_num, openPart, size):
+        attempt = 0
+        while True:
+            started = time.time()
             try:
-                log("deleting old backup: %s" % bFile)
-                bucketListResultSet = bucket.list(prefix=bFile)
-                result = bucket.delete_keys([key.name for key in bucketListResultSet])
-            except:
-                log("Couldn't delete backup from s3 %.  Exception: %." % (bFile, traceback.format_exc()))
-        else:
-            log('not deleting relevant bFile in backup_files: %s' % bFile)
-
-def filterBackupFiles(all_backup_files):
-    filterdBackupFiles = []
-    (num_hours, num_days, num_weeks, num_months, num_years) = options.rollingPattern.split(",")
-    filterdBackupFiles.extend(all_backup_files["yearly"][0:int(num_years)])
-    log('adding yearlys: %s' % len(all_backup_files["yearly"][0:int(num_years)]))
-    for a in all_backup_files["yearly"][0:int(num_years)]:
-        log('saving years: %s' % a)
-    filterdBackupFiles.extend(all_backup_files["monthly"][0:int(num_months)])
-    log('adding monthly: %s' % len(all_backup_files["monthly"][0:int(num_months)]))
-    for a in all_backup_files["monthly"][0:int(num_months)]:
-        log('saving months: %s' % a)
-    filterdBackupFiles.extend(all_backup_files["weekly"][0:int(num_weeks)])
-    log('adding weekly: %s' % len(all_backup_files["weekly"][0:int(num_weeks)]))
-    for a in all_backup_files["weekly"][0:int(num_weeks)]:
-        log('saving weekly: %s' % a)
-    filterdBackupFiles.extend(all_backup_files["daily"][0:int(num_days)])
-    log('adding daily: %s' % len(all_backup_files["daily"][0:int(num_days)]))
-    for a in all_backup_files["daily"][0:int(num_days)]:
-        log('saving daily: %s' % a)
-    filterdBackupFiles.extend(all_backup_files["hourly"][0:int(num_hours)])
-    log('adding hourly: %s' % len(all_backup_files["hourly"][0:int(num_hours)]))
-    for a in all_backup_files["hourly"][0:int(num_hours)]:
-        log('saving hourly: %s' % a)
-    return filterdBackupFiles
-
-def downloadFromS3(s3_key, localFile):
-    bucket = getS3BackupBucket()
-    log("downloading [%s] from s3 bucket: %s" % (localFile, bucket))
-    key = bucket.get_key(s3_key)
-    key.get_contents_to_filename(localFile)
+                fp = openPart()
+                try:
+                    ## with the digest up front boto reads the part only once, while sending
+                    ## it - which is when --upload-limit holds it back
+                    with self.lock:
+                        md5 = self.partMd5s.get(part_num)
+                    if md5 is None:
+                        md5 = boto.utils.compute_md5(fp, size=size)[0]
+                        with self.lock:
+                            self.partMd5s[part_num] = md5
+                    md5 = contentMd5(md5)
+                    if GOVERNOR is not None:
+                        fp = ThrottledReader(fp, GOVERNOR.upload)
+                    mp.upload_part_from_file(fp, part_num=part_num, size=size, md5=md5)
+                finally:
+                    fp.close()
+                break
+            except Exception as e:
+                attempt += 1
+                if attempt > options.uploadRetries:
+                    raise
+                delay = min(2 ** attempt, 60)
+                log("part %d of [%s] failed (attempt %d of %d), retrying in %ds: %s" % (part_num, self.s3Key, attempt, options.uploadRetries, delay, e), logging.WARNING)
+                time.sleep(delay)
+        elapsed = max(time.time() - started, 0.001)
+        with self.lock:
+            self.partCount += 1
+            self.bytesUploaded += size
+        log("uploaded part %d of [%s]: %d bytes in %.2fs (%.2f MB/s)" % (part_num, self.s3Key, size, elapsed, size / elapsed / 1048576))
+
+    def wait(self):
+        with self.lock:
+            while self.outstanding:
+                self.lock.wait()
+
+    def finish(self):
+        self.wait()
+        if self.failure is not None:
+            self.abort()
+            error("upload of [%s] failed: %s" % (self.s3Key, self.failure))
+        completed = self.mp.complete_upload()
+        ## every part was checked against its Content-MD5, this checks s3 put them together right
+        expected = multipartEtag([self.partMd5s[part_num] for part_num in sorted(self.partMd5s)])
+        etag = getattr(completed, "etag", None)
+        if etag and etag.strip('"') != expected:
+            error("s3 has the etag %s for [%s], its parts add up to %s" % (etag, self.s3Key, expected))
+        elapsed = max(time.time() - self.started, 0.001)
+        log("uploaded [%s]: %d bytes in %d parts in %.2fs (%.2f MB/s with %d workers)" % (self.s3Key, self.bytesUploaded, self.partCount, elapsed, self.bytesUploaded / elapsed / 1048576, self.concurrency))
+        REPORT.record("upload", elapsed, self.bytesUploaded, 1)
+
+    def abort(self):
+        if self.aborted:
+            return
+        self.aborted = True
+        self.wait()
+        log("aborting upload of [%s]" % self.s3Key)
+        try:
+            self.mp.cancel_upload()
+        except:
+            log("Couldn't abort the upload of [%s].  Exception: %s" % (self.s3Key, traceback.format_exc()), logging.WARNING)
+
+def gzipBlock(data, level):
+    ## each block becomes a complete gzip member - a series of members is still one
+    ## valid gzip stream for tar, gunzip and python's gzip module
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return GZIP_HEADER + compressor.compress(data) + compressor.flush() + struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+
+class GzipCodec(object):
+    ## Codecs compress a block into a frame that decompresses on its own. Frames written
+    ## one after the other are still a valid stream for the codec's command line tool.
+    name = "gzip"
+    extension = ".tar.gz"
+    module = None
+    defaultLevel = 6
+    storeLevel = 0
+
+    def compress(self, data, level):
+        return gzipBlock(data, level)
+
+    def decompress(self, frame):
+        return zlib.decompress(frame, 16 + zlib.MAX_WBITS)
+
+class ZstdCodec(object):
+    name = "zstd"
+    extension = ".tar.zst"
+    module = "zstandard"
+    defaultLevel = 3
+    storeLevel = 1
+
+    def compress(self, data, level):
+        ## the frame header records the block size, which decompress() needs
+        return zstandard.ZstdCompressor(level=level, write_content_size=True).compress(data)
+
+    def decompress(self, frame):
+        return zstandard.ZstdDecompressor().decompress(frame)
+
+class Lz4Codec(object):
+    name = "lz4"
+    extension = ".tar.lz4"
+    module = "lz4"
+    defaultLevel = 0
+    storeLevel = 0
+
+    def compress(self, data, level):
+        return lz4frame.compress(data, compression_level=level, store_size=True)
+
+    def decompress(self, frame):
+        return lz4frame.decompress(frame)
+
+class NoneCodec(object):
+    name = "none"
+    extension = ".tar"
+    module = None
+    defaultLevel = 0
+    storeLevel = 0
+
+    def compress(self, data, level):
+        return data
+
+    def decompress(self, frame):
+        return frame
+
+CODECS = dict((codec.name, codec) for codec in [GzipCodec(), ZstdCodec(), Lz4Codec(), NoneCodec()])
+
+def getCodec(name):
+    codec = CODECS[name]
+    if (codec.name == "zstd" and zstandard is None) or (codec.name == "lz4" and lz4frame is None):
+        error("the %s codec needs the %s python module, which isn't installed" % (codec.name, codec.module))
+    return codec
+
+def isIncompressible(fileobj, size):
+    ## compresses a sample from the middle of the file as fast as zlib can - media and
+    ## archives barely shrink at all, anything that does is worth compressing properly
+    fileobj.seek(size // 2)
+    sample = fileobj.read(ADAPTIVE_SAMPLE_SIZE)
+    fileobj.seek(0)
+    return len(zlib.compress(sample, 1)) >= ADAPTIVE_STORE_RATIO * len(sample)
+
+class ParallelCompressWriter(object):
+    ## A pigz style file object: what is written is cut into fixed size blocks which are
+    ## compressed by a pool of threads (zlib, zstd and lz4 all release the gil) and written
+    ## out in order. Only a couple of blocks per thread are ever in flight.
+    def __init__(self, fileobj, threads, codec=None, level=None, blockSize=COMPRESS_BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.codec = codec or CODECS["gzip"]
+        if level is None:
+            level = self.codec.defaultLevel
+        self.defaultLevel = level
+        self.level = level
+        self.blockSize = blockSize
+        self.pool = None
+        if threads > 1:
+            self.pool = ThreadPool(threads)
+        self.maxPending = 2 * threads
+        self.pending = collections.deque()
+        self.buffer = []
+        self.buffered = 0
+        self.size = 0
+        self.compressedSize = 0
+        self.storedSize = 0
+        ## (offset in the uncompressed stream, offset in the compressed stream) of every block
+        self.blocks = []
+        self.written = 0
+        self.closed = False
+
+    def write(self, data):
+        ## everything archived passes through here, so this is where --read-limit holds the readers back
+        throttleRead(len(data))
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.size += len(data)
+        if self.level != self.defaultLevel:
+            self.storedSize += len(data)
+        while self.buffered >= self.blockSize:
+            data = "".join(self.buffer)
+            self.buffer = [data[self.blockSize:]]
+            self.buffered = len(self.buffer[0])
+            self.compressBlock(data[:self.blockSize])
+
+    def setLevel(self, level):
+        ## ends the current block early, so everything written from here on is compressed at the new level
+        if level == self.level:
+            return
+        if self.buffered:
+            self.compressBlock("".join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+        self.level = level
+
+    def compressBlock(self, data):
+        if self.pool is None:
+            self.writeBlock(len(data), self.codec.compress(data, self.level))
+            return
+        self.pending.append((len(data), self.pool.apply_async(self.codec.compress, (data, self.level))))
+        while len(self.pending) >= self.maxPending:
+            self.writePendingBlock()
+
+    def writePendingBlock(self):
+        (size, result) = self.pending.popleft()
+        self.writeBlock(size, result.get())
+
+    def writeBlock(self, size, block):
+        self.blocks.append((self.written, self.compressedSize))
+        self.written += size
+        self.fileobj.write(block)
+        self.compressedSize += len(block)
+
+    def tell(self):
+        return self.size
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        ## an empty stream still needs one frame to be valid
+        if self.buffered or self.size == 0:
+            self.compressBlock("".join(self.buffer))
+        self.buffer = []
+        while self.pending:
+            self.writePendingBlock()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+    def abort(self):
+        self.closed = True
+        self.pending.clear()
+        if self.pool is not None:
+            self.pool.terminate()
+
+class DigestWriter(object):
+    ## Passes everything written to it on to fileobj, keeping a sha256 of all of it and an
+    ## md5 of every partSize bytes - the parts its multipart upload is cut into, so their
+    ## Content-MD5 and the etag of the upload are known without reading them again.
+    def __init__(self, fileobj, partSize):
+        self.fileobj = fileobj
+        self.partSize = partSize
+        self.sha256 = hashlib.sha256()
+        self.part = hashlib.md5()
+        self.partFill = 0
+        self.parts = []
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        rest = data
+        while rest:
+            take = self.partSize - self.partFill
+            self.part.update(rest[:take])
+            self.partFill += min(take, len(rest))
+            rest = rest[take:]
+            if self.partFill == self.partSize:
+                self.finishPart()
+        self.fileobj.write(data)
+
+    def finishPart(self):
+        self.parts.append(self.part.hexdigest())
+        self.part = hashlib.md5()
+        self.partFill = 0
+
+    def finish(self):
+        ## the last part may be short, and an empty archive still has one part
+        if self.partFill or not self.parts:
+            self.finishPart()
+
+    def summary(self, name, multipart):
+        ## more than 10000 parts are uploaded in bigger ones, which these don't add up to
+        etag = None
+        if not multipart:
+            etag = self.parts[0]
+        elif len(self.parts) <= 10000:
+            etag = multipartEtag(self.parts)
+        return {"name": name, "size": self.size, "sha256": self.sha256.hexdigest(), "partSize": self.partSize, "parts": self.parts, "etag": etag}
+
+def contentMd5(hexdigest):
+    ## the (hex, base64) pair boto takes as the Content-MD5 of an upload
+    return (hexdigest, base64.b64encode(binascii.unhexlify(hexdigest)))
+
+def multipartEtag(parts):
+    ## s3's etag of a multipart upload is the md5 of the md5s of its parts
+    return "%s-%d" % (hashlib.md5("".join(binascii.unhexlify(part) for part in parts)).hexdigest(), len(parts))
+
+class S3StreamWriter(object):
+    ## A write-only file object that turns whatever is written to it into the parts
+    ## of a multipart upload as soon as a full part is buffered. Because the uploader
+    ## blocks while the upload pool is busy, the writer (and so the compressor feeding
+    ## it) is held back whenever s3 can't keep up. At most one part is buffered here -
+    ## the parts waiting and being sent are shared with every other stream of the process.
+    def __init__(self, s3_key):
+        self.s3Key = s3_key
+        ## the final size is unknown, so the part size caps the archive at 10000 parts
+        self.partSize = getPartSize(0)
+        self.uploader = MultipartUploader(s3_key)
+        self.buffer = []
+        self.buffered = 0
+        self.partNum = 0
+        self.size = 0
+        self.closed = False
+        ## the md5s a DigestWriter in front of this one keeps of the same parts
+        self.partDigests = None
+        log("streaming [%s] with %d byte parts" % (s3_key, self.partSize))
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.size += len(data)
+        while self.buffered >= self.partSize:
+            data = "".join(self.buffer)
+            self.buffer = [data[self.partSize:]]
+            self.buffered = len(self.buffer[0])
+            self.sendPart(data[:self.partSize])
+
+    def sendPart(self, data):
+        self.partNum += 1
+        md5 = None
+        if self.partDigests is not None and len(self.partDigests) >= self.partNum:
+            md5 = self.partDigests[self.partNum - 1]
+        self.uploader.submit(self.partNum, lambda: StringIO(data), len(data), md5)
+
+    def tell(self):
+        return self.size
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        ## the last part may be short, and an empty archive still needs one part
+        if self.buffered or self.partNum == 0:
+            self.sendPart("".join(self.buffer))
+        self.buffer = []
+        self.uploader.finish()
+
+    def abort(self):
+        self.closed = True
+        self.buffer = []
+        self.uploader.abort()
 
 def uploadToS3(localFile, s3_key):
-    bucket = getS3BackupBucket()
     # Upload file to s3 bucket
-    log("uploading [%s] to s3 bucket: %s" % (localFile, bucket))
+    log("uploading [%s] to s3 bucket: %s" % (localFile, options.s3BackupBucket))
     source_size = os.stat(localFile).st_size
     log("source_size: %d" % source_size)
-    mp = bucket.initiate_multipart_upload(s3_key, encrypt_key=True)
-    chunk_size = 52428800
-    chunk_count = int(math.ceil(source_size / chunk_size))
+    chunk_size = getPartSize(source_size)
+    ## the md5s of the parts of an archive are taken while it is written
+    digests = ARCHIVE_DIGESTS.pop(localFile, None)
+    partMd5s = []
+    if digests is not None and digests["partSize"] == chunk_size and digests["size"] == source_size:
+        partMd5s = digests["parts"]
+    if source_size < chunk_size:
+        ## a single part isn't worth the extra multipart requests
+        started = time.time()
+        throttleUpload(source_size)
+        md5 = contentMd5(partMd5s[0]) if partMd5s else None
+        getS3BackupBucket().new_key(s3_key).set_contents_from_filename(localFile, encrypt_key=True, md5=md5)
+        REPORT.record("upload", time.time() - started, source_size, 1)
+        return
+    ## an empty file still needs one (empty) part
+    chunk_count = max(int(math.ceil(source_size / float(chunk_size))), 1)
+    uploader = MultipartUploader(s3_key)
     # Send the file parts, using FileChunkIO to create a file-like object
     # that points to a certain byte range within the original file. We
     # set bytes to never exceed the original file size
-    for i in range(chunk_count + 1):
-        offset = chunk_size * i
-        bytes = min(chunk_size, source_size - offset)
-        with FileChunkIO(localFile, 'r', offset=offset, bytes=bytes) as fp:
-            mp.upload_part_from_file(fp, part_num=i + 1)
+    try:
+        for i in range(chunk_count):
+            offset = chunk_size * i
+            bytes = min(chunk_size, source_size - offset)
+            uploader.submit(i + 1, lambda offset=offset, bytes=bytes: FileChunkIO(localFile, 'r', offset=offset, bytes=bytes), bytes,
+                            partMd5s[i] if partMd5s else None)
+    except:
+        uploader.abort()
+        raise
     # Finish the upload
-    mp.complete_upload()
+    uploader.finish()
     
+class DirectoryWatcher(object):
+    ## Keeps track of which --directory trees changed since they were last backed up, from
+    ## inotify events when pyinotify is installed and by rescanning every --poll-interval
+    ## seconds otherwise. Everything starts out dirty (and due straight away), since
+    ## nothing says what changed while the daemon wasn't running.
+    def __init__(self, directories):
+        self.directories = directories
+        self.lock = threading.Lock()
+        self.mode = None
+        now = time.time()
+        ## directory -> [first change, last change] since it was last backed up
+        self.dirty = dict((directory, [now, now - options.quietTime]) for directory in directories)
+
+    def start(self):
+        if pyinotify is not None:
+            self.mode = "inotify"
+            self.startInotify()
+        else:
+            self.mode = "polling"
+            thread = threading.Thread(target=self.poll)
+            thread.daemon = True
+            thread.start()
+
+    def startInotify(self):
+        mask = (pyinotify.IN_MODIFY | pyinotify.IN_ATTRIB | pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE | pyinotify.IN_DELETE |
+                pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO | pyinotify.IN_DELETE_SELF | pyinotify.IN_MOVE_SELF)
+        if options.snapshot in ("auto", "hardlink"):
+            ## every hard link a snapshot makes or removes changes the link count of a file,
+            ## which would mark the directories as changed after every backup - changes to
+            ## only the mode or owner of a file are picked up by the next backup instead
+            mask &= ~pyinotify.IN_ATTRIB
+        self.manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.ThreadedNotifier(self.manager, self.handleEvent)
+        self.notifier.daemon = True
+        self.notifier.start()
+        for directory in self.directories:
+            ## excluded subtrees aren't watched at all
+            self.manager.add_watch(directory, mask, rec=True, auto_add=True,
+                                   exclude_filter=lambda path, directory=directory: self.isExcluded(directory, path, True))
+
+    def handleEvent(self, event):
+        if event.mask & pyinotify.IN_Q_OVERFLOW:
+            log("the inotify queue overflowed, treating every directory as changed", logging.WARNING)
+            for directory in self.directories:
+                self.markDirty(directory)
+            return
+        for directory in self.directories:
+            if event.pathname == directory or event.pathname.startswith(directory.rstrip("/") + "/"):
+                if not self.isExcluded(directory, event.pathname, event.dir):
+                    self.markDirty(directory)
+                return
+
+    def isExcluded(self, directory, path, isDir):
+        relpath = os.path.relpath(path, directory)
+        if relpath == ".":
+            return False
+        return getExcludeMatcher().excluded(path, relpath, os.path.basename(path), isDir)
+
+    def poll(self):
+        fingerprints = {}
+        while True:
+            for directory in self.directories:
+                try:
+                    fingerprint = fingerprintDirectory(directory)
+                except (IOError, OSError):
+                    fingerprint = None
+                if directory in fingerprints and fingerprints[directory] != fingerprint:
+                    self.markDirty(directory)
+                fingerprints[directory] = fingerprint
+            time.sleep(options.pollInterval)
+
+    def markDirty(self, directory):
+        now = time.time()
+        with self.lock:
+            self.dirty.setdefault(directory, [now, now])[1] = now
+
+    def takeDue(self, quietTime, maxWait):
+        ## the directories that have been quiet long enough (or dirty for too long) - they
+        ## count as clean from here on, so changes made while they are backed up are caught
+        now = time.time()
+        with self.lock:
+            due = sorted(directory for (directory, (first, last)) in self.dirty.iteritems()
+                         if now - last >= quietTime or (maxWait and now - first >= maxWait))
+            for directory in due:
+                del self.dirty[directory]
+        return due
+
+    def status(self):
+        with self.lock:
+            return dict((directory, list(times)) for (directory, times) in self.dirty.iteritems())
+
+def fingerprintDirectory(directory):
+    ## a digest of the state of everything the backup would archive
+    digest = hashlib.sha1()
+    for (path, arcname, st) in scanDirectory(directory, background=True):
+        digest.update("%s\0%d\0%d\0%d\0%d\n" % (arcname, st.st_mode, st.st_size, st.st_mtime, st.st_ino))
+    return digest.hexdigest()
+
+def runDaemon():
+    ## Stays resident and backs up the directories that changed once they have been quiet
+    ## for --quiet-time seconds. The s3 connection, the bucket and the catalog are kept
+    ## between backups instead of being set up again by every run.
+    global REPORT
+    watcher = DirectoryWatcher(options.backupDirectories)
+    watcher.start()
+    status = {"started": time.time(), "state": "idle", "runs": 0, "failures": 0, "lastRun": None}
+    if options.statusSocket:
+        startStatusServer(options.statusSocket, lambda: daemonStatus(watcher, status))
+    ## SIGTERM stops the daemon the same way ctrl-c does, so the log and report are flushed
+    signal.signal(signal.SIGTERM, stopDaemon)
+    signal.signal(signal.SIGHUP, reopenLog)
+    log("watching %d directories (%s), backing up after %ds without changes" % (len(options.backupDirectories), watcher.mode, options.quietTime))
+    try:
+        while True:
+            directories = watcher.takeDue(options.quietTime, options.maxWait)
+            if not directories:
+                flushLog()
+                time.sleep(1)
+                continue
+            log("backing up changed directories: %s" % directories)
+            status["state"] = "backing up"
+            started = time.time()
+            result = "failed"
+            timestamp = None
+            try:
+                timestamp = backupDirectories(directories)
+                result = "ok"
+            except (Exception, SystemExit):
+                log("backup of %s failed, retrying once they are quiet again: %s" % (directories, traceback.format_exc()), logging.ERROR)
+                for directory in directories:
+                    watcher.markDirty(directory)
+                status["failures"] += 1
+            status["runs"] += 1
+            status["state"] = "idle"
+            status["lastRun"] = {"timestamp": timestamp, "status": result, "directories": directories, "seconds": time.time() - started,
+                                 "finished": datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")}
+            try:
+                writeReport(result)
+            except Exception:
+                log("Couldn't write the run report: %s" % traceback.format_exc(), logging.WARNING)
+            REPORT = RunReport()
+    except KeyboardInterrupt:
+        log("stopping the daemon")
+
+def stopDaemon(signum, frame):
+    raise KeyboardInterrupt()
+
+def daemonStatus(watcher, status):
+    now = time.time()
+    dirty = watcher.status()
+    return dict(status, watcher=watcher.mode, uptime=now - status["started"], queueDepth=len(dirty),
+                dirty=dict((directory, {"dirtySeconds": now - first, "quietSeconds": now - last}) for (directory, (first, last)) in dirty.iteritems()))
+
+class StatusHandler(SocketServer.StreamRequestHandler):
+    ## whoever connects gets the status of the daemon as json
+    def handle(self):
+        self.wfile.write(json.dumps(self.server.getStatus(), indent=2, sort_keys=True) + "\n")
+
+def startStatusServer(path, getStatus):
+    ## a socket left behind by an earlier daemon is replaced, anything else is left alone
+    if os.path.lexists(path):
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            error("[%s] exists and isn't a socket" % path)
+        os.unlink(path)
+    server = SocketServer.ThreadingUnixStreamServer(path, StatusHandler)
+    server.daemon_threads = True
+    server.getStatus = getStatus
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    log("serving status on [%s]" % path)
+
 def main():
     ## basic premise is this:
     ##   run a restore check on first launch... 
@@ -373,68 +2851,134 @@ def main():
     ##     script success means restore
     ##       run the pre-restore if it exists
     ##       restore
+    ##       verify it when asked to
     ##       run the post-restore if it exists
+    ##   or just verify the directories when asked to
     ##   run the pre-backup if it exists
     ##     do not continue on error
+    ##   take the snapshots if asked to
+    ##     then run the post backup straight away
     ##   run the backup (tar gz)
     ##   run the post backup if it exists
     ##     error is logged but script contineues
     ##   upload to s3
 
+    ##   regenerate the catalog when asked to
+    if options.rebuildCatalog:
+        rebuildCatalog()
+        return
+
+    ##   just print the retention plan when asked to
+    if options.dryRun:
+        cleanupOldBackups(dryRun=True)
+        return
+
+    ##   lower the priorities and set up the rate limits before anything runs in parallel
+    startGovernor()
+
     ##   run a restore check on first launch... 
     if options.restore == True:
         ## run the pre-restore if it exists
-        preRestoreRc = runScript(options.preRestoreScript, onFailure = "sys.exit(1)")
+        preRestoreRc = runScript(options.preRestoreScript, onFailure = "sys.exit(1)", phase = "pre-restore-script")
         if preRestoreRc == 0:
             ## restore if prerestore is ok
             restoreDirectories()
+            ## check what was restored before anything gets to change it
+            if options.verify:
+                verifyDirectories()
             ## run the post-restore if it exists
-            postRestoreRc = runScript(options.postRestoreScript, onFailure = "sys.exit(1)")
+            postRestoreRc = runScript(options.postRestoreScript, onFailure = "sys.exit(1)", phase = "post-restore-script")
             if preRestoreRc != 0:
                 sys.exit(preRestoreRc)
         else:
             error("pre restore script exited with code [%d].. exiting" % rc)
+    elif options.verify:
+        verifyDirectories()
+    elif options.daemon:
+        runDaemon()
     else:
-        ## lets make sure the directories are valid
-        for directory in options.backupDirectories:
-            if os.path.exists(directory) == False:
-                error("invalid directory specified [%s]" % directory)
-        
-        ##   run the pre-backup if it exists
-        if options.preBackupScript:
-            ## do not continue on error
-            rc = runScript(options.preBackupScript, onFailure = "sys.exit(1)")
-            if rc != 0:
-                sys.exit(rc)
-        ## run the backup (tar gz)
-        tar_files = runBackup()
-    
-        ##   run the post backup if it exists
-        if options.postBackupScript:
-            ## continue on error
-            rc = runScript(options.postBackupScript, onFailure = "")
-            if rc != 0:
-                ## error is logged but script contineues
-                log("Post backup did not execute succesfully")
-            else:
-                log("Post backup executed succesfully")
+        backupDirectories(options.backupDirectories)
+
+def backupDirectories(directories):
+    ## lets make sure the directories are valid
+    for directory in directories:
+        if os.path.exists(directory) == False:
+            error("invalid directory specified [%s]" % directory)
     
-        ## upload to s3
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-        log("timestamp: %s" % timestamp)
+    ##   run the pre-backup if it exists
+    ## the directories are frozen from here until the post backup script is done
+    frozenAt = time.time()
+    if options.preBackupScript:
+        ## do not continue on error
+        rc = runScript(options.preBackupScript, onFailure = "sys.exit(1)", phase = "pre-script")
+        if rc != 0:
+            sys.exit(rc)
+    ## the timestamp is needed up front when streaming straight to s3
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
+    log("timestamp: %s" % timestamp)
+    REPORT.timestamp = timestamp
+
+    ## until the snapshot is in the catalog, a failure discards everything it put in s3
+    try:
+        if options.snapshot != "none":
+            ## archive from a copy, so the directories are only frozen while it is taken -
+            ## even when that fails, they can't be left frozen
+            try:
+                takeSnapshots(directories)
+            finally:
+                runPostBackupScript(frozenAt)
+
+        ## run the backup (tar gz)
+        tar_files = runBackup(timestamp, directories)
+        tar_files += carryOverSnapshots(timestamp, directories)
+        releaseSnapshots()
+
+        if options.snapshot == "none":
+            runPostBackupScript(frozenAt)
+
+        ## upload to s3 (nothing left to do here when streaming)
         for tar_file in tar_files:
             s3_backup_key = "%s/%s/%s" % (options.s3Prefix, timestamp, os.path.basename(tar_file))
             log("s3_backup_key: %s" % s3_backup_key)
             uploadToS3(tar_file, s3_backup_key)
-        cleanupOldBackups()
+        recordThrottling()
+        addSnapshotToCatalog(timestamp)
+    except:
+        discardSnapshot(timestamp)
+        raise
+    finally:
+        releaseSnapshots()
+    cleanupOldBackups()
+    return timestamp
+
+def runPostBackupScript(frozenAt):
+    ##   run the post backup if it exists
+    if options.postBackupScript:
+        ## continue on error
+        rc = runScript(options.postBackupScript, onFailure = "", phase = "post-script")
+        if rc != 0:
+            ## error is logged but script contineues
+            log("Post backup did not execute succesfully")
+        else:
+            log("Post backup executed succesfully")
+    if options.preBackupScript or options.postBackupScript:
+        elapsed = time.time() - frozenAt
+        log("the directories were frozen for %.2fs, from the pre backup script to the end of the post backup script" % elapsed)
+        REPORT.record("freeze", elapsed)
 
-options = parseArgs()
+if __name__ == "__main__":
+    options = parseArgs()
 
-if options.version:
-    print version
-    sys.exit(0)
+    if options.version:
+        print version
+        sys.exit(0)
 
-log("connecting to s3 region %s" % options.s3BackupRegion)
-s3 = boto.s3.connect_to_region(options.s3BackupRegion, calling_format=OrdinaryCallingFormat())
+    log("connecting to s3 region %s" % options.s3BackupRegion)
+    s3 = connectS3()
 
-main()
+    status = "failed"
+    try:
+        main()
+        status = "ok"
+    finally:
+        writeReport(status)